@@ -0,0 +1,68 @@
+"""
+Compares the numpy cleanup engine (AudioCleaner) with the torchaudio one
+on import time and processing time, using QuickWhisper.sox_cleanup.
+
+Import times are measured in fresh interpreters. The audio is a synthetic
+utterance: tones with pauses of various lengths and some background noise.
+
+Usage:
+    python benchmarks/cleanup.py --duration=60 --repeat=5
+"""
+import sys
+import time
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from quick_whisper_typer import QuickWhisper, AudioCleaner
+
+SAMPLE_RATE = 16000
+
+
+def import_time(statement: str) -> float:
+    code = f"import time; t = time.time(); {statement}; print(time.time() - t)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip())
+
+
+def synthetic_utterance(duration: float) -> bytes:
+    rng = np.random.default_rng(0)
+    n = int(duration * SAMPLE_RATE)
+    t = np.arange(n) / SAMPLE_RATE
+    samples = rng.normal(0, 0.0005, n)
+    pos = 0
+    while pos < n:
+        talk = int(rng.uniform(1, 4) * SAMPLE_RATE)
+        samples[pos:pos + talk] += 0.2 * np.sin(2 * np.pi * rng.uniform(150, 600) * t[pos:pos + talk])
+        pos += talk + int(rng.uniform(0.2, 2.5) * SAMPLE_RATE)
+    return (samples.clip(-1, 1) * 32767).astype(np.int16).tobytes()
+
+
+def main(duration: float = 60, repeat: int = 5):
+    pcm = synthetic_utterance(duration)
+
+    print(f"numpy engine import: {import_time('import numpy, scipy.signal'):.3f}s")
+    print(f"torchaudio engine import: {import_time('import numpy, torch, torchaudio'):.3f}s")
+
+    cleaner = AudioCleaner(QuickWhisper.sox_cleanup, SAMPLE_RATE)
+    cleaner.clean(pcm)  # warm up
+    start = time.time()
+    for _ in range(repeat):
+        out = cleaner.clean(pcm)
+    print(f"numpy engine: {(time.time() - start) / repeat:.3f}s for {duration}s of audio, output {len(out) / 2 / SAMPLE_RATE:.2f}s")
+
+    import torch
+    import torchaudio
+    waveform = torch.from_numpy(np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768)[None, :]
+    torchaudio.sox_effects.apply_effects_tensor(waveform, SAMPLE_RATE, QuickWhisper.sox_cleanup)
+    start = time.time()
+    for _ in range(repeat):
+        out, _ = torchaudio.sox_effects.apply_effects_tensor(waveform, SAMPLE_RATE, QuickWhisper.sox_cleanup)
+    print(f"torchaudio engine: {(time.time() - start) / repeat:.3f}s for {duration}s of audio, output {out.shape[1] / SAMPLE_RATE:.2f}s")
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,86 @@
+"""
+Measures the stop-to-text latency of deepgram_live and checks the
+transcript that DeepgramLiveTranscriber assembles.
+
+A local websocket stand-in replaces deepgram: it replays canned final
+results, one per `--result_seconds` of audio received, and after
+CloseStream it waits `--server_delay` seconds, sends the results of the
+remaining audio then closes the socket like deepgram does. Audio blocks are
+fed in real time like PCMRecorder would.
+
+Usage:
+    python benchmarks/deepgram_live.py --duration=10 --server_delay=0.2
+"""
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+
+from websockets.sync.server import serve
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from quick_whisper_typer import DeepgramLiveTranscriber, PCMRecorder
+
+SAMPLE_RATE = 16000
+CANNED = ["The quick brown fox", "jumps over", "the lazy dog."]
+
+
+def result(transcript: str) -> str:
+    return json.dumps({
+        "type": "Results",
+        "is_final": True,
+        "channel": {"alternatives": [{"transcript": transcript, "confidence": 0.99}]},
+    })
+
+
+def make_handler(result_seconds: float, server_delay: float):
+    def handler(websocket):
+        assert "encoding=linear16" in websocket.request.path, websocket.request.path
+        assert websocket.request.headers["Authorization"] == "Token stand-in"
+        received = 0
+        sent = 0
+        for message in websocket:
+            if isinstance(message, bytes):
+                # interim results are ignored by the client
+                websocket.send(json.dumps({"type": "Results", "is_final": False, "channel": {"alternatives": [{"transcript": "..."}]}}))
+                received += len(message)
+                if received >= (sent + 1) * result_seconds * SAMPLE_RATE * 2:
+                    websocket.send(result(CANNED[sent % len(CANNED)]))
+                    sent += 1
+            elif json.loads(message)["type"] == "CloseStream":
+                time.sleep(server_delay)
+                websocket.send(result(CANNED[sent % len(CANNED)]))
+                websocket.send(json.dumps({"type": "Metadata", "duration": received / 2 / SAMPLE_RATE}))
+                return
+
+    return handler
+
+
+def main(duration: float = 10, result_seconds: float = 3, server_delay: float = 0.2):
+    server = serve(make_handler(result_seconds, server_delay), "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"ws://127.0.0.1:{server.socket.getsockname()[1]}/v1/listen"
+
+    block_size = SAMPLE_RATE * 2 * PCMRecorder.block_ms // 1000
+    pcm = bytes(int(duration * SAMPLE_RATE) * 2)
+    live = DeepgramLiveTranscriber(SAMPLE_RATE, api_key="stand-in", language="en", url=url)
+    for i in range(0, len(pcm), block_size):
+        live.feed(pcm[i:i + block_size])
+        time.sleep(PCMRecorder.block_ms / 1000)
+    start = time.time()
+    text = live.finish()
+    latency = time.time() - start
+    server.shutdown()
+
+    nb_results = int(duration // result_seconds) + 1
+    expected = " ".join(CANNED[i % len(CANNED)] for i in range(nb_results))
+    assert text == expected, f"{text!r} != {expected!r}"
+    print(f"Utterance: {duration}s, stand-in delay after CloseStream: {server_delay}s")
+    print(f"Transcript: {text!r}")
+    print(f"Stop-to-text latency: {latency:.3f}s")
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
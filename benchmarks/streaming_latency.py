@@ -0,0 +1,97 @@
+"""
+Measures the stop-to-text latency of streaming_transcription against the
+classic "upload everything after shift" behavior.
+
+A local stand-in server replaces the transcription server: it takes
+`--server_speed` seconds of processing per second of audio and always
+answers with the same word. A synthetic utterance made of tones separated
+by pauses is fed to StreamingTranscriber in real time.
+
+Usage:
+    python benchmarks/streaming_latency.py --duration=30 --server_speed=0.1
+"""
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import requests
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from quick_whisper_typer import StreamingTranscriber, PCMRecorder, pcm_to_wav
+
+SAMPLE_RATE = 16000
+
+
+def make_handler(server_speed: float):
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            # multipart overhead is negligible compared to the pcm
+            audio_seconds = len(body) / 2 / SAMPLE_RATE
+            time.sleep(audio_seconds * server_speed)
+            answer = b'{"text": "word"}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    return StandInHandler
+
+
+def synthetic_utterance(duration: float) -> bytes:
+    "3s of tone then 0.6s of silence, repeated"
+    t = np.arange(int(3 * SAMPLE_RATE)) / SAMPLE_RATE
+    tone = (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16)
+    pause = np.zeros(int(0.6 * SAMPLE_RATE), dtype=np.int16)
+    pattern = np.concatenate([tone, pause])
+    n = int(duration * SAMPLE_RATE)
+    return np.resize(pattern, n).tobytes()
+
+
+def post(url: str, audio: bytes) -> str:
+    response = requests.post(url, files={"file": ("audio.wav", audio)})
+    response.raise_for_status()
+    return response.json()["text"]
+
+
+def main(duration: float = 30, server_speed: float = 0.1, chunk_seconds: float = 8.0):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(server_speed))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/inference"
+    pcm = synthetic_utterance(duration)
+    block_size = SAMPLE_RATE * 2 * PCMRecorder.block_ms // 1000
+
+    # classic: everything is sent after the user stops
+    start = time.time()
+    post(url, pcm_to_wav(pcm, SAMPLE_RATE))
+    classic = time.time() - start
+
+    # streaming: blocks are fed at the speed of the microphone
+    streamer = StreamingTranscriber(
+        transcribe=lambda chunk: post(url, pcm_to_wav(chunk, SAMPLE_RATE)),
+        sample_rate=SAMPLE_RATE,
+        min_chunk_seconds=chunk_seconds,
+    )
+    for i in range(0, len(pcm), block_size):
+        streamer.feed(pcm[i:i + block_size])
+        time.sleep(PCMRecorder.block_ms / 1000)
+    start = time.time()
+    streamer.finish()
+    streaming = time.time() - start
+
+    server.shutdown()
+    print(f"Utterance: {duration}s, server speed: {server_speed}s per audio second")
+    print(f"Classic stop-to-text latency: {classic:.3f}s")
+    print(f"Streaming stop-to-text latency: {streaming:.3f}s ({len(streamer.futures)} chunks)")
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Thin client for `quick_whisper_typer.py --daemon`.
+It imports almost nothing so that the keybinding starts instantly, all the
+heavy lifting is done by the daemon that is already warm.
+
+Examples:
+    python quick_whisper_client.py --task=write
+    python quick_whisper_client.py --task=write --LLM_instruction=instructions/corrector.txt
+    python quick_whisper_client.py --task=continue_voice_chat --whisper_prompt="Hi"
+
+Use --daemon_socket=PATH if the daemon was started with a custom socket.
+Use --jobs to print the status of the recent jobs of the daemon.
+"""
+import sys
+import os
+import json
+import socket
+
+
+def default_socket() -> str:
+    "same as the daemon's default: daemon.sock in the platformdirs cache dir"
+    if sys.platform == "darwin":
+        cache = os.path.expanduser("~/Library/Caches")
+    else:
+        cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "QuickWhisperTyper", "daemon.sock")
+
+
+def parse_args(argv: list) -> dict:
+    "parse --key=value, --key value and --flag like fire would"
+    args = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith("--"):
+            raise Exception(f"Non keyword args are not supported: {arg}")
+        arg = arg[2:]
+        if "=" in arg:
+            key, value = arg.split("=", 1)
+        elif i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+            key, value = arg, argv[i + 1]
+            i += 1
+        else:
+            key, value = arg, "true"
+        try:
+            value = json.loads(value)
+        except ValueError:
+            if value in ("True", "False"):
+                value = value == "True"
+        if isinstance(value, str) and os.path.isfile(value):
+            # the daemon resolves paths against its own working directory
+            value = os.path.abspath(value)
+        args[key] = value
+        i += 1
+    return args
+
+
+def main() -> int:
+    args = parse_args(sys.argv[1:])
+    path = args.pop("daemon_socket", None) or default_socket()
+    if "task" in args:
+        args["task"] = args["task"].replace("-", "_").lower()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError as err:
+            print(f"Couldn't reach the daemon at {path}: {err}", file=sys.stderr)
+            return 1
+        sock.sendall(json.dumps(args).encode() + b"\n")
+        reply = sock.makefile("rb").readline()
+
+    reply = json.loads(reply) if reply else {"status": "error", "error": "No reply from daemon"}
+    if reply["status"] == "error":
+        print(f"Error: {reply['error']}", file=sys.stderr)
+        return 1
+    for job in reply.get("jobs", []):
+        error = f" ({job['error']})" if job["error"] else ""
+        print(f"{job['id']}\t{job['task']}\t{job['state']}{error}\t{job['seconds']}s")
+    for line in reply.get("voice_chats", []):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,19 @@
 import sys
-from typing import List, Optional, Union
+import re
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 import threading
 import queue
+import io
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import time
 import platform
 from platformdirs import user_cache_dir
 import requests
 import os
-import psutil
 try:
     from uuid6 import uuid6 as uuid
 except Exception:
@@ -34,15 +39,37 @@ class QuickWhisper:
         "transform_clipboard": "You transform INPUT_TEXT according to an "
             "instruction. Only reply the transformed text without anything "
             "else. No extra formatting, don't wraps in quotes etc",
+        "summarize_chat": "You summarize the beginning of a conversation "
+            "between a user and an assistant. The summary will replace those "
+            "messages so keep every fact, decision and open question that "
+            "could matter later, as concisely as you can. Only reply the "
+            "summary.",
     }
     allowed_tasks = (
         "transform_clipboard",
         "new_voice_chat",
         "continue_voice_chat",
+        "list_voice_chats",
         "write",
     )
+    path_args = ("piper_model_path",)  # never replaced by their file content
+    stream_paste_seconds = 0.3  # stream_output pastes at most that often
+    paste_settle_seconds = 0.2  # ctrl+v can read the clipboard that late
     allowed_voice_engine = ("openai", "piper", "espeak", "deepgram", None)
 
+    # settings of the voice engines, also used to key the speech cache
+    tts_settings = {
+        "openai": {"model": "tts-1", "voice": "echo", "speed": 1.3},
+        "deepgram": {"model": "aura-asteria-en"},
+    }
+
+    # most compact format accepted by each transcription backend
+    backend_upload_format = {
+        "openai": "opus",
+        "deepgram": "opus",
+        "custom": "wav",  # whisper.cpp only accepts wav without --convert
+    }
+
     # arguments to do voice cleanup before sending to whisper
     sox_cleanup = [
         # isolate voice frequency
@@ -72,30 +99,58 @@ class QuickWhisper:
         llm_model: str = "openai/gpt-4o",
         auto_paste: bool = False,
         restore_clipboard: bool = False,
+        two_phase_paste: bool = False,
+        stream_output: bool = False,
         sound_cleanup: bool = False,
+        cleanup_engine: str = "numpy",
         whisper_prompt: str = None,
         whisper_lang: str = None,
         voice_engine: str = None,
         piper_model_path: str = None,
+        piper_pool_size: int = 2,
+        tts_cache_mb: float = 100,
         disable_voice: bool = False,
+        stream_voice: bool = False,
+        conversation_id: Optional[int] = None,
+        chat_token_budget: int = 0,
         LLM_instruction: str = None,
+        reuse_last_recording: bool = False,
         gui: bool = False,
+        auto_stop_silence_ms: int = 0,
         loop: bool = False,
         loop_shift_nb: int = 3,
         loop_time_window: int = 2,
         loop_tasks: dict = {"n":{"task":"new_voice_chat"}, "c": {"task":"continue_voice_chat"}, "w": {"task": "write"}, "t": {"task": "transform_clipboard"}, "s": {"extra_args": "disable_voice"}},
+        loop_ring_seconds: float = 10,
+        loop_preroll: float = 0.5,
         verbose: bool = False,
         disable_bells: bool = False,
         disable_notifications: bool = False,
         deepgram_transcription: bool = False,
         custom_transcription_url: Optional[str] = None,
+        transcription_backends: Optional[Union[str, List[str]]] = None,
+        hedge_backend: Optional[str] = None,
+        hedge_percentile: float = 90,
+        local_whisper_model: str = "small",
+        local_whisper_threads: int = 4,
+        local_whisper_beam_size: int = 1,
+        upload_format: Optional[str] = None,
+        streaming_transcription: bool = False,
+        streaming_chunk_seconds: float = 8.0,
+        deepgram_live: bool = False,
+        deepgram_live_url: Optional[str] = None,
+        parallel_chunk_seconds: float = 0,
+        transcription_workers: int = 4,
+        daemon: bool = False,
+        daemon_socket: Optional[str] = None,
+        job_workers: int = 3,
     ):
         """
         Parameters
         ----------
         task
-            transform_clipboard, write, new_voice_chat, continue_voice_chat
-            or None if --loop
+            transform_clipboard, write, new_voice_chat, continue_voice_chat,
+            list_voice_chats or None if --loop
 
         llm_model: str, default "openai/gpt-4o
             language model to use for the task except if task==write
@@ -107,12 +162,32 @@ class QuickWhisper:
             wether to automatically restore your previous clipboard if
             auto_paste is used.
 
+        two_phase_paste: bool, default False
+            for the write task with an LLM_instruction and auto_paste: the
+            raw transcript is pasted as soon as it is available, then it is
+            selected with shift+left and replaced by the LLM output. Don't
+            move the cursor while the LLM is working.
+
+        stream_output: bool, default False
+            for the write task with an LLM_instruction and for
+            transform_clipboard, with auto_paste: the LLM output is pasted
+            by batches while it is generated instead of all at once at the
+            end. The clipboard contains the whole output at the end, or is
+            restored if restore_clipboard is used.
+
         sound_cleanup: bool, default False
-            Clean up the sound before sending it to whisper, but this adds
+            Clean up the sound before sending it to whisper. With the numpy
+            cleanup_engine the filters run on the audio while it is being
+            recorded so almost no latency is added, with torchaudio this adds
             latency depending of how powerful your computer is.
-            This uses sox, to modify the arguments, look at the value
+            This uses sox effects, to modify the arguments, look at the value
             of self.sox_cleanup
 
+        cleanup_engine: str, default "numpy"
+            "numpy" to apply self.sox_cleanup with the numpy/scipy
+            implementation in AudioCleaner, which is much lighter to
+            import, or "torchaudio" to use torchaudio's sox bindings.
+
         whisper_prompt: str, default None
             prompt to given to whisper
 
@@ -127,20 +202,70 @@ class QuickWhisper:
             For example 'en_US-lessac-medium'. Make sure you have 
             a .onxx and .json file present.
             More info: https://github.com/rhasspy/piper
+            Can also be set per task in loop_tasks.
+            The piper audio is played while it is being synthesized.
+
+        piper_pool_size: int, default 2
+            number of piper models kept loaded, the least recently used one
+            is unloaded when a loop task needs another model.
+
+        tts_cache_mb: float, default 100
+            maximum size of the cache of synthesized speech, stored in the
+            cache dir. Speech from openai, deepgram and piper is keyed by a
+            hash of the engine, model or voice, speed and text so repeated
+            answers are played without calling the engine. The least
+            recently used entries are removed first. 0 to disable.
 
         disable_voice: bool, default False
             This flag disables the voice_engine. It can be used to toggle on
             or off the voice_engine in the loop.
 
+        stream_voice: bool, default False
+            if True, the LLM answer of the voice chats is streamed and each
+            sentence is synthesized and played while the next ones are still
+            being generated and synthesized, so the time to first audio only
+            depends on the first sentence.
+
+        conversation_id: int, default None
+            id of the voice chat to resume with continue_voice_chat, the
+            latest one is resumed if None. The voice chats are stored in
+            conversations.sqlite in the cache dir, use the list_voice_chats
+            task to see their ids.
+
+        chat_token_budget: int, default 0
+            if given, maximum number of tokens of voice chat history sent to the LLM.
+            After the answer is spoken, if the history is larger, its oldest
+            messages are summarized in the background into a short system
+            note so the next turns stay fast and cheap. The token count of
+            each message is stored with it. 0 to always send everything,
+            without counting tokens nor extra LLM calls.
+
         LLM_instruction: str, default None
             if given, then the transcript will be given to an LLM and tasked
             to modify it according to those instructions. Meaning this is
             the system prompt.
 
+        reuse_last_recording: bool, default False
+            if True, nothing is recorded and the task is run again on the
+            last recording. Recordings and their transcripts are kept in
+            the cache dir, keyed by a hash of the audio, backend, language
+            and prompt, so the same audio is never transcribed twice. This
+            is useful to retry when the LLM call or the clipboard failed.
+            Can be used in loop_tasks too, for example:
+            {"r": {"task": "write", "reuse_last_recording": true}}
+
         gui, default to False
             if True, a window will open to allow to enter specific prompts etc
             if False, no window is used and you have to press shift to stop the recording.
 
+        auto_stop_silence_ms: int, default 0
+            if not 0, the recording stops by itself once you have spoken and
+            then stayed silent for that many milliseconds, as if shift was
+            pressed. Silence is detected by VoiceActivityDetector. Ignored
+            if gui is used.
+            Note that the leading and trailing silences are always
+            removed before sending the audio for transcription.
+
         loop: bool, default False
             if True, will run an endless loop. If you press the shift key
             loop_shift_nb times you can call quick_whisper from anywhere.
@@ -159,6 +284,16 @@ class QuickWhisper:
             if a value of the arguments is a filepath, it will be replaced by the file's content (useful to add long prompts)
             You always have to specify a "task" key/val except to toggle the voice via {"extra_args": "disable_voice"}
 
+        loop_ring_seconds: float, default 10
+            in loop mode the microphone is always being captured into a
+            ring buffer that keeps that many seconds of audio, so that a
+            recording starts instantly. Set to 0 to start a new capture
+            for each recording instead.
+
+        loop_preroll: float, default 0.5
+            number of seconds taken from the ring buffer before the trigger
+            and prepended to the recording, so the first word is not lost.
+
         verbose: bool, default False
 
         disable_bells: bool, default False
@@ -171,16 +306,108 @@ class QuickWhisper:
             if True, use deepgram instead of openai's whisper for transcription.
             whisper_prompt and whisper_lang will be ignored.
             Python >=3.10 is needed
-            Incompatible with custom_transcription_url
 
         custom_transcription_url: str
             if set to for example "http://127.0.0.1:8080/inference" then the
             audio file will be send there for transcription.
             You can try with whispercpp with this command for example:
             `./server -m models/small_acft_q8_0.bin --threads 8 --audio-ctx 1500 -l fr --no-gpu --debug-mode --convert -p 1`
-            Note: If the custom transcription fails, it will not fallback to OpenAI's Whisper.
-            The transcription will fail entirely.
-            Incompatible with deepgram_transcription
+            Note: If the custom transcription fails, it will not fallback to
+            OpenAI's Whisper unless it is part of transcription_backends.
+
+        transcription_backends: str or list, default None
+            ordered list of the transcription backends among "local",
+            "custom", "deepgram" and "openai", for example "custom,openai". If a
+            backend fails, the next one is used. After repeated failures a
+            backend is skipped until it is reachable again, see
+            TranscriptionRouter. If None: custom if custom_transcription_url
+            is set, then deepgram if deepgram_transcription, and openai if
+            none of them.
+
+        hedge_backend: str, default None
+            "openai" or "deepgram", added at the end of the
+            transcription_backends. If set and the first backend has not
+            answered within its usual latency, the same audio is also sent
+            to the next healthy backend and the first valid transcript is
+            used, the other one is discarded.
+
+        hedge_percentile: float, default 90
+            the deadline before hedging is this percentile of the recent
+            latencies of the backend, per second of audio. The local
+            backend is never hedged as its losing request can't be stopped.
+
+        local_whisper_model: str, default "small"
+            model used by the "local" transcription backend: a size like
+            "base" or "small" or the path of a CTranslate2 model. It runs
+            in-process on the CPU with int8 weights using faster-whisper,
+            is loaded once while the user talks and stays loaded with
+            --loop or --daemon. The recording is given to it directly,
+            without encoding or HTTP.
+
+        local_whisper_threads: int, default 4
+            number of CPU threads of the local backend.
+
+        local_whisper_beam_size: int, default 1
+            beam size of the local backend, 1 is greedy decoding which is
+            the fastest.
+
+        upload_format: str, default None
+            wav, flac or opus. Format used to send the 16kHz mono audio for
+            transcription. If None, the most compact format accepted by the
+            backend is used, see QuickWhisper.backend_upload_format.
+            The size sent and the encoding time are logged.
+
+        streaming_transcription: bool, default False
+            if True, the recording is cut into chunks at silences and each
+            chunk is sent for transcription while you are still talking.
+            When shift is pressed only the last chunk remains to be
+            transcribed and the partial transcripts are stitched together.
+            sound_cleanup is not applied to the chunks.
+
+        streaming_chunk_seconds: float, default 8.0
+            minimum duration of a chunk before it can be cut at the next
+            silence when using streaming_transcription.
+
+        deepgram_live: bool, default False
+            if True, the audio is streamed to deepgram's live websocket while
+            it is being recorded and the transcript is ready almost as soon
+            as shift is pressed. Needs DEEPGRAM_API_KEY and the websockets
+            package (installed with deepgram-sdk). Only whisper_lang is
+            used, sound_cleanup is not applied. If it fails, the recording
+            is transcribed by the transcription_backends.
+
+        deepgram_live_url: str, default None
+            websocket url used instead of deepgram's by deepgram_live, for
+            example a stand-in server like in benchmarks/deepgram_live.py
+
+        parallel_chunk_seconds: float, default 0
+            if not 0, recordings longer than twice that duration are split
+            at silences into chunks of about that duration which are
+            transcribed concurrently then joined in order. Each chunk is
+            given the end of the previous chunk's transcript as
+            whisper_prompt if it is already available when it is sent.
+
+        transcription_workers: int, default 4
+            number of chunks transcribed at the same time when using
+            parallel_chunk_seconds.
+
+        daemon: bool, default False
+            if True, stays resident with every module and model loaded and
+            listens on a unix socket for requests sent by
+            quick_whisper_client.py. This way each keybinding starts warm.
+            Can be combined with loop.
+
+        daemon_socket: str, default None
+            path of the unix socket used by the daemon. Defaults to
+            daemon.sock in the cache dir.
+
+        job_workers: int, default 3
+            with --loop or --daemon, each triggered task is a job run by
+            one of that many threads: a new recording can start while the
+            previous jobs are being transcribed or sent to the LLM. Only one
+            job records at a time and the outputs (paste, speech) happen in
+            the order the jobs were triggered. See JobScheduler, the status
+            of the jobs can be queried with `quick_whisper_client.py --jobs`.
 
         Environment Variables
         ---------------------
@@ -194,7 +421,24 @@ class QuickWhisper:
         if verbose:
             global DEBUG_IMPORT
             DEBUG_IMPORT = True
-        assert not (custom_transcription_url and deepgram_transcription), "Cannot use a custom transcription url and ask for deepgram!"
+        if transcription_backends is None:
+            transcription_backends = []
+            if custom_transcription_url:
+                transcription_backends.append("custom")
+            if deepgram_transcription:
+                transcription_backends.append("deepgram")
+            if not transcription_backends:
+                transcription_backends.append("openai")
+        elif isinstance(transcription_backends, str):
+            transcription_backends = transcription_backends.split(",")
+        transcription_backends = [b.strip() for b in transcription_backends]
+        assert hedge_backend in (None, "openai", "deepgram"), f"Invalid hedge_backend {hedge_backend}"
+        if hedge_backend and hedge_backend not in transcription_backends:
+            transcription_backends.append(hedge_backend)
+        assert transcription_backends, "transcription_backends can't be empty"
+        for backend in transcription_backends:
+            assert backend in ("local", "custom", "deepgram", "openai"), f"Invalid transcription backend {backend}"
+        assert custom_transcription_url or "custom" not in transcription_backends, "The custom backend needs a custom_transcription_url"
 
         # check arguments
         if gui is True:
@@ -220,74 +464,127 @@ class QuickWhisper:
                 raise Exception(f"FileNotFound for pipermodelpath: {piper_model_path}")
         task = task.replace("-", "_").lower()
         assert (
-            loop or task in self.allowed_tasks
+            loop or daemon or task in self.allowed_tasks
         ), f"Invalid task {task} not part of {self.allowed_tasks}"
-        if loop:
-                assert not task, "If using loop, you must leave task to None"
-
-        # to reduce startup time, use threaded module import
-        to_import = [
-            "from playsound import playsound",
-            "from plyer import notification",
-        ]
+        if loop or daemon:
+                assert not task, "If using loop or daemon, you must leave task to None"
+        # the daemon needs the same modules as the loop
+        resident = loop or daemon
+
+        # to reduce startup time, import in the background, the lower the
+        # priority the sooner the module is needed
+        self.imports = ImportRegistry()
+        self.imports.add("from pynput import keyboard", 0)
+        self.imports.add("from playsound import playsound", 0, fallback="from playsound3 import playsound")
+        self.imports.add("from plyer import notification", 0)
         if os_type == "Linux":
-            to_import.append("import subprocess")
+            self.imports.add("import subprocess", 0)
         else:
-            to_import.append("from plyer import audio_recorder")
+            self.imports.add("import sounddevice as sd", 1)
         if gui:
-            to_import.append("import PySimpleGUI as sg")
-        else:
-            to_import.append("from pynput import keyboard")
-        to_import.append("import os")
-        if sound_cleanup:
-            to_import.append("import torchaudio")
-            to_import.append("import soundfile as sf")
-        if not deepgram_transcription:
-            to_import.append("from litellm import completion, transcription")
+            self.imports.add("import PySimpleGUI as sg", 0)
+        self.imports.add("import os", 0)
+        self.imports.add("import numpy as np", 1)
+        self.imports.add("import soundfile as sf", 3)
+        assert cleanup_engine in ("numpy", "torchaudio"), f"Invalid cleanup_engine {cleanup_engine}"
+        # sound_cleanup and voice_engine can be set per task when resident
+        if (sound_cleanup or resident) and cleanup_engine == "numpy":
+            self.imports.add("import scipy.signal", 2)
+        elif sound_cleanup or resident:
+            self.imports.add("import torch", 2)
+            self.imports.add("import torchaudio", 2)
+        if "openai" in transcription_backends:
+            self.imports.add("from litellm import completion, transcription, token_counter", 3)
         else:
+            self.imports.add("from litellm import completion, token_counter", 3)
+        if "local" in transcription_backends:
+            self.imports.add("from faster_whisper import WhisperModel", 2)
+        if "deepgram" in transcription_backends:
             assert int(sys.version.split(".")[1]) >= 10, "deepgram needs python 3.10+"
-            to_import.append("from litellm import completion")
-            to_import.append("from deepgram import DeepgramClient, PrerecordedOptions")
-        if loop or task == "write":
-            to_import.append("import json")
-        if loop or task == "write" or task == "transform_clipboard":
-            to_import.append("import pyclip")
-        if loop or "voice" in task:
-            if voice_engine:
-                if voice_engine == "piper":
-                    to_import.append("from piper.voice import PiperVoice as piper")
-                    to_import.append("import wave")
-                    if piper_model_path:
-                        to_import.append(f"voice = piper.load('{piper_model_path}')")
-                elif voice_engine == "openai":
-                    to_import.append("from openai import OpenAI")
-                elif voice_engine == "deepgram":
-                    to_import.append("from deepgram import DeepgramClient, ClientOptionsFromEnv, SpeakOptions")
-
-        self.import_thread = threading.Thread(target=importer, args=(to_import,), daemon=False)
-        self.import_thread.start()
+            self.imports.add("from deepgram import DeepgramClient, PrerecordedOptions", 3)
+        if resident or task == "write":
+            self.imports.add("import json", 1)
+        if resident or task == "write" or task == "transform_clipboard":
+            self.imports.add("import pyclip", 4)
+        voice_engines = ("piper", "openai", "deepgram") if resident else ()
+        if "voice" in task and voice_engine:
+            voice_engines = (voice_engine,)
+        if "piper" in voice_engines:
+            self.imports.add("from piper.voice import PiperVoice as piper", 4)
+        if "openai" in voice_engines:
+            self.imports.add("from openai import OpenAI", 4)
+        if "deepgram" in voice_engines:
+            self.imports.add("from deepgram import DeepgramClient, ClientOptionsFromEnv, SpeakOptions", 4)
+        self.imports.start()
 
         # store arguments
         self.verbose = verbose
         self.gui = gui
+        self.auto_stop_silence_ms = auto_stop_silence_ms
         self.llm_model = llm_model
         self.voice_engine = voice_engine
         self.piper_model_path = piper_model_path
+        self.piper_voices = PiperVoicePool(piper_pool_size)
+        self.tts_cache = TTSCache(cache_dir / "tts_cache", int(tts_cache_mb * 1024 * 1024), log=self.log) if tts_cache_mb else None
+        if voice_engine == "piper" and "piper" in voice_engines:
+            # load the onnx model while the user is talking, if a task can speak
+            threading.Thread(target=self.piper_voice, args=(piper_model_path,), daemon=True).start()
         self.auto_paste = auto_paste
         self.restore_clipboard = restore_clipboard
+        self.two_phase_paste = two_phase_paste
+        self.stream_output = stream_output
         self.sound_cleanup = sound_cleanup
+        self.cleanup_engine = cleanup_engine
         self.LLM_instruction = LLM_instruction
+        self.reuse_last_recording = reuse_last_recording
+        self.transcript_cache = TranscriptCache(cache_dir / "transcripts")
         self.whisper_lang = whisper_lang
         self.whisper_prompt = whisper_prompt
         self.disable_notifications = disable_notifications
         self.disable_bells = disable_bells
         self.disable_voice = disable_voice
+        self.conversation_id = conversation_id
+        self.chat_token_budget = chat_token_budget
+        self.compacting = threading.Lock()
+        self.conversations = ConversationStore(cache_dir / "conversations.sqlite")
+        self.stream_voice = stream_voice
         self.deepgram_transcription = deepgram_transcription
         self.custom_transcription_url = custom_transcription_url
+        self.hedge_backend = hedge_backend
+        self.hedge_percentile = hedge_percentile
+        self.router = TranscriptionRouter(
+            backends=transcription_backends,
+            urls={
+                "local": None,
+                "custom": custom_transcription_url,
+                "openai": ConnectionPool.hosts["openai"],
+                "deepgram": ConnectionPool.hosts["deepgram"],
+            },
+            log=self.log,
+        )
+        self.local_whisper_threads = local_whisper_threads
+        self.local_whisper_beam_size = local_whisper_beam_size
+        if "local" in transcription_backends:
+            # loaded while the user is talking, then kept for the loop
+            loader = ThreadPoolExecutor(max_workers=1)
+            self.local_whisper = loader.submit(self.load_local_whisper, local_whisper_model)
+            loader.shutdown(wait=False)  # its thread exits once the model is loaded
+        assert upload_format in (None, *upload_formats.keys()), f"Invalid upload_format {upload_format}"
+        self.upload_format = upload_format
+        self.streaming_transcription = streaming_transcription
+        self.streaming_chunk_seconds = streaming_chunk_seconds
+        self.deepgram_live = deepgram_live
+        self.deepgram_live_url = deepgram_live_url
+        self.parallel_chunk_seconds = parallel_chunk_seconds
+        self.transcription_workers = transcription_workers
 
         self.wait_for_module("keyboard")
         self.loop_key_triggers = [keyboard.Key.shift, keyboard.Key.shift_r]
 
+        self.jobs = JobScheduler(run=self.main, max_workers=job_workers, log=self.log)
+        if daemon:
+            self.daemon_socket = Path(daemon_socket) if daemon_socket else cache_dir / "daemon.sock"
+
         if loop:
             # the module were imported already
             if isinstance(loop_tasks, str):
@@ -304,7 +601,7 @@ class QuickWhisper:
             # replace any path in values by its content
             for k, v in loop_tasks.items():
                 for kk, vv in v.items():
-                    if Path(vv).exists():
+                    if isinstance(vv, str) and kk not in self.path_args and Path(vv).exists():
                         loop_tasks[k][kk] = Path(vv).read_text()
 
             self.loop_tasks = loop_tasks
@@ -312,8 +609,18 @@ class QuickWhisper:
             self.loop_time_window = loop_time_window
             self.waiting_for_letter = False
             self.key_buff = []
+            self.loop_preroll = loop_preroll
+            if loop_ring_seconds:
+                assert loop_preroll <= loop_ring_seconds, "loop_preroll can't be longer than loop_ring_seconds"
+                self.wait_for_audio_io()
+                self.capture = PCMRecorder(ring_seconds=loop_ring_seconds)
+                self.capture.start()
             self.wait_for_module("keyboard")
+            if daemon:
+                threading.Thread(target=self.serve, daemon=True).start()
             self.loop()
+        elif daemon:
+            self.serve()
         else:
             self.main(
                 task=task,
@@ -340,9 +647,18 @@ class QuickWhisper:
         sound_cleanup: Optional[bool] = None,
         llm_model: Optional[str] = None,
         voice_engine: Optional[str] = None,
+        piper_model_path: Optional[str] = None,
         disable_voice: Optional[bool] = None,
+        stream_voice: Optional[bool] = None,
         restore_clipboard: Optional[bool] = None,
-        custom_transcription_url: Optional[str] = None
+        custom_transcription_url: Optional[str] = None,
+        streaming_transcription: Optional[bool] = None,
+        auto_stop_silence_ms: Optional[int] = None,
+        reuse_last_recording: Optional[bool] = None,
+        conversation_id: Optional[int] = None,
+        two_phase_paste: Optional[bool] = None,
+        stream_output: Optional[bool] = None,
+        deepgram_live: Optional[bool] = None,
         ):
         "execcuted by self.loop or at the end of __init__"
 
@@ -363,104 +679,857 @@ class QuickWhisper:
             llm_model = self.llm_model
         if voice_engine is None and self.voice_engine:
             voice_engine = self.voice_engine
+        if piper_model_path is None and self.piper_model_path:
+            piper_model_path = self.piper_model_path
         if disable_voice is None and self.disable_voice:
             disable_voice = self.disable_voice
+        if stream_voice is None and self.stream_voice:
+            stream_voice = self.stream_voice
         if restore_clipboard is None and self.restore_clipboard:
             restore_clipboard = self.restore_clipboard
         if custom_transcription_url is None and self.custom_transcription_url:
             custom_transcription_url = self.custom_transcription_url
+        if streaming_transcription is None and self.streaming_transcription:
+            streaming_transcription = self.streaming_transcription
+        if auto_stop_silence_ms is None and self.auto_stop_silence_ms:
+            auto_stop_silence_ms = self.auto_stop_silence_ms
+        if reuse_last_recording is None and self.reuse_last_recording:
+            reuse_last_recording = self.reuse_last_recording
+        if conversation_id is None and self.conversation_id:
+            conversation_id = self.conversation_id
+        if two_phase_paste is None and self.two_phase_paste:
+            two_phase_paste = self.two_phase_paste
+        if stream_output is None and self.stream_output:
+            stream_output = self.stream_output
+        if deepgram_live is None and self.deepgram_live:
+            deepgram_live = self.deepgram_live
+        if stream_output and not auto_paste:
+            self.log("stream_output is ignored without auto_paste")
+            stream_output = False
 
         self.log(f"Will use prompt {self.whisper_prompt} and task {task}")
 
-        file = cache_dir / (str(uuid()) + ".mp3")
+        if task == "list_voice_chats":
+            for line in self.voice_chats():
+                print(line)
+            return
+
+        if reuse_last_recording:
+            pcm, sample_rate = self.transcript_cache.last_recording()
+            self.log(f"Reusing the last recording ({len(pcm) / 2 / sample_rate:.1f}s)")
+            text = None
+        else:
+            with self.jobs.capture_turn():
+                pcm, sample_rate, text, whisper_prompt, LLM_instruction = self.record(
+                    task=task,
+                    gui=gui,
+                    whisper_prompt=whisper_prompt,
+                    whisper_lang=whisper_lang,
+                    LLM_instruction=LLM_instruction,
+                    sound_cleanup=sound_cleanup,
+                    llm_model=llm_model,
+                    voice_engine=voice_engine,
+                    disable_voice=disable_voice,
+                    custom_transcription_url=custom_transcription_url,
+                    streaming_transcription=streaming_transcription,
+                    deepgram_live=deepgram_live,
+                    auto_stop_silence_ms=auto_stop_silence_ms,
+                )
+            # saved before transcribing so that a failure can be retried
+            self.transcript_cache.save_recording(pcm, sample_rate)
+
+        # Call whisper
+        key = self.transcript_cache.key(
+            pcm,
+            self.transcription_backend(custom_transcription_url),
+            whisper_lang,
+            whisper_prompt,
+        )
+        if text is None:
+            text = self.transcript_cache.get(key)
+            if text is not None:
+                self.log("Using the cached transcript")
+        if text is None:
+            duration = len(pcm) / 2 / sample_rate
+            if self.parallel_chunk_seconds and duration > 2 * self.parallel_chunk_seconds:
+                transcribe = self.transcribe_chunked
+            else:
+                transcribe = self.transcribe
+            text = transcribe(
+                pcm=pcm,
+                sample_rate=sample_rate,
+                whisper_prompt=whisper_prompt,
+                whisper_lang=whisper_lang,
+                custom_transcription_url=custom_transcription_url,
+            )
+            # streaming and deepgram_live transcripts are not cached as they
+            # don't come from these backends
+            self.transcript_cache.put(key, text)
+
+        assert text is not None, "Text should not be None at this point"
+        self.notif(self.log(f"Transcript: {text}"))
+
+        if task == "write":
+            if two_phase_paste and not auto_paste:
+                self.log("two_phase_paste is ignored without auto_paste")
+                two_phase_paste = False
+            answer = None
+            if LLM_instruction:
+                self.log(
+                    f"Calling {llm_model} to transfrom the transcript to follow "
+                    f"those instructions: {LLM_instruction}"
+                )
+                messages=[
+                    {
+                        "role": "system",
+                        "content": LLM_instruction,
+                    },
+                    {
+                        "role": "user",
+                        "content": text,
+                    },
+                ]
+                self.wait_for_module("json")
+                self.log(f"Messages sent to LLM:\n{json.dumps(messages, indent=4, ensure_ascii=False)}")
+
+                if not (two_phase_paste or stream_output):
+                    # no need to wait for the output of the previous jobs
+                    answer = self.complete(llm_model, messages, num_retries=3)
+                    self.log(f'LLM output: "{answer}"')
+
+            with self.jobs.output_turn():
+                self.wait_for_module("pyclip")
+                try:
+                    clipboard = pyclip.paste()
+                except Exception as err:
+                    self.log(f"Erasing the previous clipboard because error when loading it: {err}")
+                    clipboard = ""
+
+                if answer is not None:
+                    text = answer
+                elif LLM_instruction:
+                    raw = text
+                    if two_phase_paste:
+                        # the user can read the transcript while the LLM works
+                        self.log("Pasting the raw transcript")
+                        self.paste(raw, auto_paste)
+                    if stream_output:
+                        if two_phase_paste:
+                            self.log("Replacing the raw transcript")
+                            self.select_back(len(raw))
+                        text = self.paste_stream(
+                            self.complete_stream(llm_model, messages, num_retries=3),
+                            keep_answer=not restore_clipboard,
+                        )
+                    else:
+                        text = self.complete(llm_model, messages, num_retries=3)
+                        self.log("Replacing the raw transcript")
+                        self.select_back(len(raw))
+                    self.log(f'LLM output: "{text}"')
+
+                if not (LLM_instruction and stream_output):
+                    self.log("Pasting clipboard")
+                    self.paste(text, auto_paste)
+                if auto_paste and restore_clipboard:
+                    pyclip.copy(clipboard)
+                    self.log("Clipboard restored")
+
+                self.notif("Done")
+                playsound("sounds/Positive.ogg", block=False)
+
+        elif task == "transform_clipboard":
+            with self.jobs.output_turn():
+                self.log(
+                    f'Calling LLM with instruction "{text}" and tasked to transform the clipboard'
+                )
+
+                self.wait_for_module("pyclip")
+                try:
+                    clipboard = str(pyclip.paste())
+                except Exception as err:
+                    raise Exception(
+                            f"Error when loading content of clipboard: {err}")
+
+                if not clipboard:
+                    self.notif(self.log("Clipboard is empty, this is not compatible with the task"))
+                    raise SystemExit()
+                if isinstance(clipboard, str):
+                    self.log(f"Clipboard previous content: '{clipboard}'")
+                elif isinstance(clipboard, bytes):
+                    self.log(f"Clipboard previous content is binary")
+
+                assert len(clipboard) < 10000, f"Suspiciously large clipboard content: {len(clipboard)}"
+                assert len(text) < 10000, f"Suspiciously large text content: {len(text)}"
+                messages = [
+                    {
+                        "role": "system",
+                        "content": self.system_prompts["transform_clipboard"],
+                    },
+                    {
+                        "role": "user",
+                        "content": f"INPUT_TEXT: '{clipboard}'\n\nINSTRUCTION: '{text}'",
+                    },
+                ]
+                if stream_output:
+                    answer = self.paste_stream(
+                        self.complete_stream(llm_model, messages),
+                        keep_answer=not restore_clipboard,
+                    )
+                    self.log(f'LLM clipboard transformation: "{answer}"')
+                else:
+                    answer = self.complete(llm_model, messages)
+                    self.log(f'LLM clipboard transformation: "{answer}"')
+
+                    self.log("Pasting clipboard")
+                    self.paste(answer, auto_paste)
+                self.notif(answer, -1)
+                if auto_paste and restore_clipboard:
+                    pyclip.copy(clipboard)
+                    self.log("Clipboard restored")
+
+                playsound("sounds/Positive.ogg", block=False)
+
+        elif "voice_chat" in task:
+            with self.jobs.output_turn():
+                if "new" in task:
+                    conv_id = self.conversations.new()
+                    self.log(f"Creating new voice chat: {conv_id}")
+                elif "continue" in task:
+                    conv_id = conversation_id or self.conversations.latest()
+                    assert conv_id is not None, "No previous voice chat to continue"
+                    self.log(f"Continuing voice chat: {conv_id}")
+                else:
+                    raise ValueError(task)
+
+                messages = [
+                    {"role": "system", "content": self.system_prompts["voice"]},
+                ] + self.conversations.messages(conv_id)
+                messages.append({"role": "user", "content": text})
+
+                self.log(f"Calling LLM with messages: '{messages}'")
+                voice_engine = voice_engine if not disable_voice else None
+                if stream_voice and voice_engine:
+                    # speak each sentence while the next ones are generated
+                    llm_start = time.time()
+                    engine = [voice_engine]  # becomes espeak if the engine fails
+
+                    def synthesize(sentence: str) -> Union[Path, "RawAudio"]:
+                        audio, engine[0] = self.synthesize(sentence, engine[0], whisper_lang, piper_model_path)
+                        return audio
+
+                    pipeline = SpeechPipeline(
+                        synthesize=synthesize,
+                        play=self.play,
+                        log=self.log,
+                    )
+                    splitter = SentenceSplitter()
+                    answer = ""
+                    try:
+                        for delta in self.complete_stream(llm_model, messages):
+                            answer += delta
+                            for sentence in splitter.feed(delta):
+                                pipeline.say(sentence)
+                        for sentence in splitter.flush():
+                            pipeline.say(sentence)
+                    except BaseException:
+                        # the turn failed: don't speak the rest of a partial answer
+                        pipeline.drop_pending()
+                        raise
+                    finally:
+                        pipeline.close()
+                    self.log(f'LLM answer to the chat: "{answer}"')
+                    self.notif(answer, -1)
+                    if pipeline.first_audio:
+                        self.log(f"Time to first audio: {pipeline.first_audio - llm_start:.2f}s")
+                else:
+                    answer = self.complete(llm_model, messages)
+                    self.log(f'LLM answer to the chat: "{answer}"')
+                    self.notif(answer, -1)
+
+                    if voice_engine is None:
+                        self.log("voice_engine is None: not speaking.")
+                    else:
+                        self.speak(answer, voice_engine, whisper_lang, piper_model_path)
+
+                self.conversations.append(conv_id, "user", text)
+                self.conversations.append(conv_id, "assistant", answer)
+
+                if self.chat_token_budget:
+                    # not a daemon thread: a single run waits for it before exiting
+                    threading.Thread(
+                        target=self.compact_conversation,
+                        args=(conv_id, llm_model),
+                    ).start()
+
+        self.log("Done.")
+
+    def complete(self, llm_model: str, messages: List[dict], **kwargs) -> str:
+        "call the LLM with its stable prefix marked as cacheable and return the answer"
+        self.wait_for_module("completion")
+        start = time.time()
+        LLM_response = completion(
+            model=llm_model,
+            messages=cache_prompt_prefix(messages, llm_model),
+            **kwargs,
+        )
+        response = LLM_response.json()
+        self.log_usage(response.get("usage"), f"Answer in {time.time() - start:.2f}s")
+        return response["choices"][0]["message"]["content"]
+
+    def complete_stream(self, llm_model: str, messages: List[dict], **kwargs) -> Iterator[str]:
+        "same as complete but yields the answer as it is generated"
+        self.wait_for_module("completion")
+        start = time.time()
+        first_token = None
+        usage = None
+        for chunk in completion(
+            model=llm_model,
+            messages=cache_prompt_prefix(messages, llm_model),
+            stream=True,
+            stream_options={"include_usage": True},
+            drop_params=True,
+            **kwargs,
+            ):
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta and first_token is None:
+                first_token = time.time() - start
+            yield delta
+        self.log_usage(usage, f"First token in {first_token or 0:.2f}s")
+
+    def log_usage(self, usage: Optional[Union[dict, object]], timing: str) -> None:
+        "log the prompt tokens read from the provider's cache"
+        if not usage:
+            self.log(f"{timing}, no usage returned")
+            return
+
+        def get(obj, key):
+            return obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
+
+        details = get(usage, "prompt_tokens_details")
+        # openai reports prompt_tokens_details.cached_tokens, anthropic cache_read_input_tokens
+        cached = (get(details, "cached_tokens") if details else None) or get(usage, "cache_read_input_tokens") or 0
+        written = get(usage, "cache_creation_input_tokens") or 0
+        self.log(
+            f"{timing}, prompt tokens: {get(usage, 'prompt_tokens')}, "
+            f"cached: {cached} ({'hit' if cached else 'miss'}), written to cache: {written}"
+        )
+
+    def compact_conversation(self, conversation_id: int, llm_model: str) -> None:
+        "summarize the oldest messages of a voice chat that exceed self.chat_token_budget"
+        if not self.compacting.acquire(blocking=False):
+            self.log("A voice chat is already being summarized")
+            return
+        try:
+            self.wait_for_module("token_counter")
+            rows = self.conversations.unsummarized(
+                conversation_id,
+                lambda content: token_counter(model=llm_model, text=content),
+            )
+            total = sum(tokens for _, _, _, tokens in rows)
+            if total <= self.chat_token_budget:
+                return
+
+            # keep the most recent messages that fit in half of the budget
+            kept = 0
+            cut = len(rows)
+            while cut > 0 and kept + rows[cut - 1][3] <= self.chat_token_budget // 2:
+                cut -= 1
+                kept += rows[cut][3]
+            cut = max(cut, 1)
+            summary = self.conversations.summary(conversation_id)
+            transcript = "\n\n".join(f"{role}: {content}" for _, role, content, _ in rows[:cut])
+            if summary:
+                transcript = f"Summary of what came before: {summary}\n\n{transcript}"
+
+            self.log(f"Summarizing {cut} messages of voice chat {conversation_id} ({total} tokens)")
+            start = time.time()
+            summary = self.complete(
+                llm_model,
+                [
+                    {"role": "system", "content": self.system_prompts["summarize_chat"]},
+                    {"role": "user", "content": transcript},
+                ],
+            )
+            self.conversations.set_summary(conversation_id, summary, rows[cut - 1][0])
+            self.log(f"Voice chat summarized in {time.time() - start:.2f}s: {summary}")
+        except Exception as err:
+            self.log(f"Error when summarizing the voice chat: {err}")
+        finally:
+            self.compacting.release()
+
+    def torchaudio_cleanup(self, pcm: bytes, sample_rate: int) -> bytes:
+        "apply self.sox_cleanup to the PCM using torchaudio's sox bindings"
+        self.wait_for_module("torch")
+        self.wait_for_module("torchaudio")
+        waveform = torch.from_numpy(
+            np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        )[None, :]
+        waveform, new_sample_rate = torchaudio.sox_effects.apply_effects_tensor(
+            waveform,
+            sample_rate,
+            self.sox_cleanup,
+        )
+        assert new_sample_rate == sample_rate, "sox_cleanup must not resample"
+        return (waveform[0].numpy().clip(-1, 1) * 32767).astype(np.int16).tobytes()
+
+    def record(
+        self,
+        task: str,
+        gui: bool,
+        whisper_prompt: Optional[str],
+        whisper_lang: Optional[str],
+        LLM_instruction: Optional[str],
+        sound_cleanup: bool,
+        llm_model: str,
+        voice_engine: Optional[str],
+        disable_voice: bool,
+        custom_transcription_url: Optional[str],
+        streaming_transcription: bool,
+        deepgram_live: bool,
+        auto_stop_silence_ms: Optional[int],
+        ) -> Tuple[bytes, int, Optional[str], Optional[str], Optional[str]]:
+        """
+        record until shift is pressed, then return the cleaned PCM, its
+        sample rate, the transcript if it was streamed (None otherwise) and
+        the whisper_prompt and LLM_instruction as modified by the gui
+        """
         min_duration = 2  # if the recording is shorter, exit
 
         # Start recording
         start_time = time.time()
         self.stop_recording()  # just in case
-        self.log(f"Recording {file}")
-        if os_type == "Linux":
-            # Kill any previously running recordings
-            self.rec_process = subprocess.Popen(f"timeout 1h rec -r 44000 -c 1 -b 16 {file}", shell=True)
+        self.log("Recording")
+        self.wait_for_module("np")
+        if hasattr(self, "capture"):
+            # start from the always on capture of the loop
+            if not self.capture.running:
+                self.log("Restarting the loop's capture")
+                self.capture.start()
+            recorder = PCMRecorder(source=self.capture, preroll=self.loop_preroll)
         else:
-            self.wait_for_module("audio_recorder")
-            audio_recorder.start(
-                file_path=file,
-                channels=1,
-                sample_rate=44100,
-                bit_rate=128000,
+            self.wait_for_audio_io()
+            recorder = PCMRecorder()
+        streamer = None
+        if deepgram_live:
+            assert "DEEPGRAM_API_KEY" in os.environ, "deepgram_live needs the DEEPGRAM_API_KEY environment variable"
+            streamer = DeepgramLiveTranscriber(
+                sample_rate=recorder.sample_rate,
+                api_key=os.environ["DEEPGRAM_API_KEY"],
+                language=whisper_lang,
+                url=self.deepgram_live_url,
+            )
+            recorder.listeners.append(streamer.feed)
+        elif streaming_transcription:
+            streamer = StreamingTranscriber(
+                transcribe=lambda chunk: self.transcribe(
+                    pcm=chunk,
+                    sample_rate=recorder.sample_rate,
+                    whisper_prompt=whisper_prompt,
+                    whisper_lang=whisper_lang,
+                    custom_transcription_url=custom_transcription_url,
+                ),
+                sample_rate=recorder.sample_rate,
+                min_chunk_seconds=self.streaming_chunk_seconds,
+            )
+            recorder.listeners.append(streamer.feed)
+        cleaner = None
+        if streamer is None and sound_cleanup and self.cleanup_engine == "numpy":
+            # the filters run on each block during the recording
+            self.wait_for_module("scipy")
+            cleaner = AudioCleaner(self.sox_cleanup, recorder.sample_rate)
+            recorder.listeners.append(cleaner.feed)
+        auto_stopped = threading.Event()
+        shift_listeners = []
+        if auto_stop_silence_ms and not gui:
+            def auto_stop():
+                self.log(f"No voice for {auto_stop_silence_ms}ms, stopping the recording")
+                auto_stopped.set()
+                for listener in shift_listeners:
+                    listener.stop()
+
+            vad = VoiceActivityDetector(
+                sample_rate=recorder.sample_rate,
+                auto_stop_ms=auto_stop_silence_ms,
+                on_auto_stop=auto_stop,
             )
-        self.notif("Listening")
-        self.wait_for_module("playsound")
-        playsound("sounds/Slick.ogg", block=False)
+            recorder.listeners.append(vad.feed)
 
-        if gui is True:
-            # Show recording form
-            whisper_prompt, LLM_instruction = self.launch_gui(
-                whisper_prompt,
-                task,
-                )
-        else:
-            keys = self.loop_key_triggers
-            def released_shift(key):
-                "detect when shift is pressed"
-                if key in keys:
-                    self.log("Pressed shift.")
-                    time.sleep(1)
-                    return False
-                elif key in [keyboard.Key.esc, keyboard.Key.space]:
-                    self.notif(self.log("Pressed escape or spacebar: quitting."))
-                    self.stop_recording()
-                    raise SystemExit("Quitting.")
-
-            with keyboard.Listener(on_release=released_shift) as listener:
-                self.log("Shortcut listener started, press shift to stop recording, esc or spacebar to quit.")
-
-                listener.join()  # blocking
-
-        # Kill the recording
-        self.stop_recording()
-        end_time = time.time()
-        self.log(f"Done recording {file}")
-        playsound("sounds/Rhodes.ogg", block=False)
-        if gui is False:
-            self.notif("Analysing")
-
-        # Check duration
-        duration = end_time - start_time
-        self.log(f"Duration {duration}")
-        if duration < min_duration:
-            self.notif(
-                self.log(
-                    f"Recording too short ({duration} s), exiting without calling whisper."
+        def max_duration():
+            self.log(f"Recording reached {recorder.max_seconds}s, stopping it")
+            auto_stopped.set()
+            for listener in shift_listeners:
+                listener.stop()
+
+        recorder.on_max_duration = max_duration
+        try:
+            self.recorder = recorder
+            recorder.start()
+            self.notif("Listening")
+
+            # do the DNS and TLS handshakes while the user is talking
+            warmup = set()
+            for backend in self.router.order(custom_transcription_url)[:2 if self.hedge_backend else 1]:
+                url = custom_transcription_url if backend == "custom" else self.router.urls[backend]
+                if url:
+                    warmup.add(url)
+            if (task != "write" or LLM_instruction) and llm_model.startswith("openai/"):
+                warmup.add(ConnectionPool.hosts["openai"])
+            if "voice" in task and voice_engine in ("openai", "deepgram") and not disable_voice:
+                warmup.add(ConnectionPool.hosts[voice_engine])
+            connection_pool.warmup(warmup)
+
+            self.wait_for_module("playsound")
+            playsound("sounds/Slick.ogg", block=False)
+
+            if gui is True:
+                # Show recording form
+                whisper_prompt, LLM_instruction = self.launch_gui(
+                    whisper_prompt,
+                    task,
+                    )
+            else:
+                keys = self.loop_key_triggers
+                def released_shift(key, injected: bool = False):
+                    "detect when shift is pressed"
+                    if injected:
+                        # keystrokes of the output of another job, eg select_back
+                        return
+                    if key in keys:
+                        self.log("Pressed shift.")
+                        time.sleep(1)
+                        return False
+                    elif key in [keyboard.Key.esc, keyboard.Key.space]:
+                        self.notif(self.log("Pressed escape or spacebar: quitting."))
+                        self.stop_recording()
+                        raise SystemExit("Quitting.")
+
+                with keyboard.Listener(on_release=released_shift) as listener:
+                    self.log("Shortcut listener started, press shift to stop recording, esc or spacebar to quit.")
+                    shift_listeners.append(listener)
+                    if auto_stopped.is_set():
+                        listener.stop()
+
+                    listener.join()  # blocking
+
+            # Kill the recording
+            self.stop_recording()
+            end_time = time.time()
+            self.log("Done recording")
+            playsound("sounds/Rhodes.ogg", block=False)
+            if gui is False:
+                self.notif("Analysing")
+
+            # Check duration
+            duration = end_time - start_time
+            self.log(f"Duration {duration}")
+            if duration < min_duration:
+                self.notif(
+                    self.log(
+                        f"Recording too short ({duration} s), exiting without calling whisper."
+                    )
                 )
-            )
-            raise SystemExit()
+                raise SystemExit()
+        except BaseException:
+            # aborted, eg too short or esc: nothing will collect the transcript
+            self.stop_recording()
+            if streamer is not None:
+                streamer.cancel()
+            raise
+
+        text = None
+        if streamer is not None:
+            if sound_cleanup:
+                self.log("sound_cleanup is not applied when streaming the transcription")
+            try:
+                text = streamer.finish()
+                self.log(f"Stop-to-text latency: {time.time() - end_time:.2f}s")
+            except Exception as err:
+                if not deepgram_live:
+                    raise
+                self.log(f"Error with deepgram live, transcribing the recording instead: '{err}'")
 
-        if sound_cleanup:
+        pcm = recorder.pcm
+        if streamer is None and sound_cleanup:
             # clean up the sound
-            self.log("Cleaning up sound")
+            self.log(f"Cleaning up sound using {self.cleanup_engine}")
 
-            self.wait_for_module("torchaudio")
-            self.wait_for_module("sf")
             try:
-                waveform, sample_rate = torchaudio.load(file)
-                waveform, sample_rate = torchaudio.sox_effects.apply_effects_tensor(
-                    waveform,
-                    sample_rate,
-                    self.sox_cleanup,
-                )
-                file2 = file.replace(".mp3", "") + "_clean.wav"
-                sf.write(str(file2), waveform.numpy().T,
-                         sample_rate, format="wav")
-                file = file2
+                if cleaner is not None:
+                    pcm = cleaner.finish()
+                else:
+                    pcm = self.torchaudio_cleanup(pcm, recorder.sample_rate)
                 self.log("Done cleaning up sound")
             except Exception as err:
                 self.log(f"Error when cleaning up sound: {err}")
 
-        # Call whisper
-        text = None
+        if text is None:
+            trimmed = VoiceActivityDetector(recorder.sample_rate).trim(pcm)
+            self.log(f"Removed {(len(pcm) - len(trimmed)) / 2 / recorder.sample_rate:.2f}s of silence")
+            pcm = trimmed
+
+        return pcm, recorder.sample_rate, text, whisper_prompt, LLM_instruction
+
+    def speak(
+        self,
+        text: str,
+        voice_engine: str,
+        whisper_lang: Optional[str],
+        piper_model_path: Optional[str],
+        ) -> None:
+        "say the text, piper's audio is played while it is being synthesized"
+        if voice_engine == "piper":
+            try:
+                key = self.tts_cache_key(voice_engine, text, piper_model_path)
+                cached = self.tts_cache.get(key) if key else None
+                if cached:
+                    self.play(cached)
+                    return
+                piper_voice = self.piper_voice(piper_model_path)
+                self.wait_for_audio_io()
+                sink = AudioSink(piper_voice.config.sample_rate)
+                spoken = []
+                try:
+                    for frames in piper_voice.synthesize_stream_raw(piper_text(text)):
+                        sink.write(frames)
+                        spoken.append(frames)
+                finally:
+                    sink.close()
+                if key:
+                    self.tts_cache.put(key, RawAudio(b"".join(spoken), piper_voice.config.sample_rate))
+                return
+            except Exception as err:
+                self.notif(
+                    self.log(f"Error with piper, trying with espeak: '{err}'"))
+                voice_engine = "espeak"
+        audio, _ = self.synthesize(text, voice_engine, whisper_lang, piper_model_path)
+        self.play(audio)
+
+    def piper_voice(self, piper_model_path: str) -> "piper":
+        "the loaded piper model, from self.piper_voices"
+        self.wait_for_module("piper")
+        return self.piper_voices.get(piper_model_path)
+
+    def play(self, audio: Union[Path, "RawAudio"]) -> None:
+        "play an audio file or raw PCM and wait until it is done"
+        if isinstance(audio, RawAudio):
+            self.wait_for_audio_io()
+            sink = AudioSink(audio.sample_rate)
+            try:
+                sink.write(audio.pcm)
+            finally:
+                sink.close()
+        else:
+            self.log(f"Playing voice file: {audio}")
+            self.wait_for_module("playsound")
+            playsound(str(audio), block=True)
+
+    def synthesize(
+        self,
+        text: str,
+        voice_engine: str,
+        whisper_lang: Optional[str],
+        piper_model_path: Optional[str] = None,
+        ) -> Tuple[Union[Path, "RawAudio"], str]:
+        "synthesize text to an audio file or raw PCM, return it and the engine used"
+        key = self.tts_cache_key(voice_engine, text, piper_model_path)
+        cached = self.tts_cache.get(key) if key else None
+        if cached:
+            self.log(f"Using cached speech: {cached}")
+            return cached, voice_engine
+
+        vocal_file = cache_dir / str(uuid())
+        if voice_engine == "piper":
+            try:
+                piper_voice = self.piper_voice(piper_model_path)
+                pcm = b"".join(piper_voice.synthesize_stream_raw(piper_text(text)))
+                audio = RawAudio(pcm, piper_voice.config.sample_rate)
+                if key:
+                    self.tts_cache.put(key, audio)
+                return audio, voice_engine
+            except Exception as err:
+                self.notif(
+                    self.log(f"Error with piper, trying with espeak: '{err}'"))
+                voice_engine = "espeak"
+
+        if voice_engine == "deepgram":
+            self.wait_for_module("DeepgramClient")
+            try:
+                vocal_file = vocal_file.with_suffix(".mp3")
+                deepgram = connection_pool.get(
+                    "deepgram_speak",
+                    lambda: DeepgramClient(
+                        api_key="",
+                        config=ClientOptionsFromEnv()
+                    ),
+                )
+                options = SpeakOptions(
+                    model=self.tts_settings["deepgram"]["model"],
+                )
+                deepgram.speak.v("1").save(
+                    str(vocal_file),
+                    {"text": text},
+                    options,
+                )
+                if key:
+                    vocal_file = self.tts_cache.put(key, vocal_file)
+                return vocal_file, voice_engine
+            except Exception as err:
+                self.notif(
+                    self.log(f"Error with deepgram voice_engine, trying with espeak: '{err}'"))
+                voice_engine = "espeak"
+
+        if voice_engine == "openai":
+            self.wait_for_module("OpenAI")
+            try:
+                vocal_file = vocal_file.with_suffix(".mp3")
+                client = connection_pool.openai_client()
+                response = client.audio.speech.create(
+                    **self.tts_settings["openai"],
+                    input=text,
+                    response_format="mp3",
+                )
+                response.stream_to_file(str(vocal_file.absolute()))
+                if key:
+                    vocal_file = self.tts_cache.put(key, vocal_file)
+                return vocal_file, voice_engine
+            except Exception as err:
+                self.notif(
+                    self.log(f"Error with openai voice_engine, trying with espeak: '{err}'"))
+                voice_engine = "espeak"
+
+        assert voice_engine == "espeak", f"Unexpected voice_engine {voice_engine}"
+        import subprocess
+        vocal_file = vocal_file.with_suffix(".wav")
+        if whisper_lang:
+            subprocess.run(
+                ["espeak", "-v", whisper_lang, "-p", "20", "-s", "110", "-z", "-w", str(vocal_file), text]
+            )
+        else:
+            subprocess.run(
+                ["espeak", "-p", "20", "-s", "110", "-z", "-w", str(vocal_file), text]
+            )
+        return vocal_file, voice_engine
+
+    def tts_cache_key(
+        self,
+        voice_engine: str,
+        text: str,
+        piper_model_path: Optional[str],
+        ) -> Optional[str]:
+        "key of the speech in the cache, None if it should not be cached"
+        if self.tts_cache is None:
+            return None
+        if voice_engine == "piper":
+            model, speed = str(Path(piper_model_path).absolute()), None
+        elif voice_engine in self.tts_settings:
+            settings = self.tts_settings[voice_engine]
+            model = "/".join(str(v) for k, v in settings.items() if k != "speed")
+            speed = settings.get("speed")
+        else:
+            return None
+        return TTSCache.key(voice_engine, model, speed, text)
+
+    def transcription_backend(self, custom_transcription_url: Optional[str]) -> str:
+        "configured backends, stable whatever their health so that it can key the transcript cache"
+        backends = list(self.router.backends)
         if custom_transcription_url:
+            backends.insert(0, f"custom={custom_transcription_url}")
+        return ",".join(backends)
+
+    def transcribe(
+        self,
+        pcm: bytes,
+        sample_rate: int,
+        whisper_prompt: Optional[str],
+        whisper_lang: Optional[str],
+        custom_transcription_url: Optional[str],
+        ) -> str:
+        "transcribe with the healthiest backend of self.router"
+        return self.router.transcribe(
+            transcribe=lambda backend: self.transcribe_backend(
+                backend,
+                pcm=pcm,
+                sample_rate=sample_rate,
+                whisper_prompt=whisper_prompt,
+                whisper_lang=whisper_lang,
+                custom_transcription_url=custom_transcription_url or self.custom_transcription_url,
+            ),
+            duration=len(pcm) / 2 / sample_rate,
+            hedge_percentile=self.hedge_percentile if self.hedge_backend else None,
+            custom_transcription_url=custom_transcription_url,
+        )
+
+    def load_local_whisper(self, model: str) -> "WhisperModel":
+        self.wait_for_module("WhisperModel")
+        start = time.time()
+        local_whisper = WhisperModel(
+            model,
+            device="cpu",
+            compute_type="int8",
+            cpu_threads=self.local_whisper_threads,
+        )
+        self.log(f"Loaded local whisper model {model} in {time.time() - start:.2f}s")
+        return local_whisper
+
+    def transcribe_local(
+        self,
+        pcm: bytes,
+        sample_rate: int,
+        whisper_prompt: Optional[str],
+        whisper_lang: Optional[str],
+        ) -> str:
+        "transcribe the PCM in-process with faster-whisper"
+        assert sample_rate == 16000, f"faster-whisper expects 16kHz audio, not {sample_rate}"
+        try:
+            local_whisper = self.local_whisper.result()
+        except Exception as err:
+            raise Exception(f"Error when loading the local whisper model: '{err}'")
+        self.log(f"Calling local whisper for {len(pcm) / 2 / sample_rate:.1f}s of audio")
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        segments, _ = local_whisper.transcribe(
+            audio,
+            language=whisper_lang,
+            initial_prompt=whisper_prompt,
+            beam_size=self.local_whisper_beam_size,
+            temperature=0,
+            condition_on_previous_text=False,
+        )
+        text = "".join(segment.text for segment in segments).strip()
+        assert text, "Empty text from local whisper"
+        return text
+
+    def transcribe_backend(
+        self,
+        backend: str,
+        pcm: bytes,
+        sample_rate: int,
+        whisper_prompt: Optional[str],
+        whisper_lang: Optional[str],
+        custom_transcription_url: Optional[str],
+        ) -> str:
+        "encode the PCM for the transcription backend, send it and return the text"
+        if backend == "local":
+            return self.transcribe_local(pcm, sample_rate, whisper_prompt, whisper_lang)
+        upload_format = self.upload_format or self.backend_upload_format[backend]
+        if upload_format != "wav":
+            self.wait_for_module("sf")
+        start = time.time()
+        try:
+            audio, filename = encode_audio(pcm, sample_rate, upload_format)
+        except Exception as err:
+            self.log(f"Error when encoding audio to {upload_format}, using wav instead: '{err}'")
+            audio, filename = encode_audio(pcm, sample_rate, "wav")
+        self.log(
+            f"Sending {len(audio)} bytes as {filename} to {backend} for "
+            f"{len(pcm) / 2 / sample_rate:.1f}s of audio "
+            f"(raw: {len(pcm)} bytes, encoded in {(time.time() - start) * 1000:.0f}ms)"
+        )
+
+        text = None
+        if backend == "custom":
             self.log(f"Calling server at {custom_transcription_url}")
 
             headers = {
@@ -478,13 +1547,12 @@ class QuickWhisper:
             if "CUSTOM_WHISPER_MODEL" in os.environ:
                 data["model"] = os.environ["CUSTOM_WHISPER_MODEL"]
             try:
-                with open(file, "rb") as f:
-                    response = requests.post(
-                        custom_transcription_url,
-                        headers=headers,
-                        files={'file': f},
-                        data=data
-                    )
+                response = connection_pool.session().post(
+                    custom_transcription_url,
+                    headers=headers,
+                    files={'file': (filename, audio)},
+                    data=data
+                )
                 response.raise_for_status()
                 transcript_response = response.json()
                 if "error" in transcript_response:
@@ -496,26 +1564,27 @@ class QuickWhisper:
                 self.log(f"Error when using custom transcription server: '{err}'")
                 raise Exception(f"Custom transcription failed: {err}")
 
-        if text is None and (not self.deepgram_transcription):
+        if backend == "openai":
             self.log("Calling whisper")
             self.wait_for_module("transcription")
-            with open(file, "rb") as f:
-                transcript_response = transcription(
-                    model="whisper-1",
-                    file=f,
-                    language=whisper_lang,
-                    prompt=whisper_prompt,
-                    temperature=0,
-                    max_retries=3,
-                )
+            connection_pool.configure_litellm()
+            f = io.BytesIO(audio)
+            f.name = filename
+            transcript_response = transcription(
+                model="whisper-1",
+                file=f,
+                language=whisper_lang,
+                prompt=whisper_prompt,
+                temperature=0,
+                max_retries=3,
+            )
             text = transcript_response.text
 
-
-        if text is None:
-            assert self.deepgram_transcription
+        if backend == "deepgram":
             self.log("Calling deepgram")
+            self.wait_for_module("DeepgramClient")
             try:
-                deepgram = DeepgramClient()
+                deepgram = connection_pool.get("deepgram_listen", DeepgramClient)
             except Exception as err:
                 raise Exception(f"Error when creating deepgram client: '{err}'")
             # set options
@@ -546,8 +1615,7 @@ class QuickWhisper:
                 # filler_words=False,
             )
             options = PrerecordedOptions(**options)
-            with open(file, "rb") as f:
-                payload = {"buffer": f.read()}
+            payload = {"buffer": audio}
             content = deepgram.listen.prerecorded.v("1").transcribe_file(
                 payload,
                 options,
@@ -557,243 +1625,107 @@ class QuickWhisper:
             text = content["results"]["channels"][0]["alternatives"][0]["paragraphs"]["transcript"].strip()
             assert text, "Empty text from deepgram transcription"
 
-        assert text is not None, "Text should not be None at this point"
-        self.notif(self.log(f"Transcript: {text}"))
-
-        if task == "write":
-            self.wait_for_module("pyclip")
+        assert text is not None, f"Unknown transcription backend {backend}"
+        return text
+
+    def serve(self) -> None:
+        "listen on a unix socket for requests sent by quick_whisper_client.py"
+        import socketserver
+        self.wait_for_module("json")
+        if self.daemon_socket.exists():
+            self.daemon_socket.unlink()
+        qw = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reply = qw.handle_request(self.rfile.readline())
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        # one thread per client so that their jobs can be pipelined
+        with socketserver.ThreadingUnixStreamServer(str(self.daemon_socket), RequestHandler) as server:
+            server.daemon_threads = True
+            self.daemon_socket.chmod(0o600)
+            self.log(f"Daemon listening on {self.daemon_socket}", True)
             try:
-                clipboard = pyclip.paste()
-            except Exception as err:
-                self.log(f"Erasing the previous clipboard because error when loading it: {err}")
-                clipboard = ""
-
-            if LLM_instruction:
-                self.log(
-                    f"Calling {llm_model} to transfrom the transcript to follow "
-                    f"those instructions: {LLM_instruction}"
-                )
-                messages=[
-                    {
-                        "role": "system",
-                        "content": LLM_instruction,
-                    },
-                    {
-                        "role": "user",
-                        "content": text,
-                    },
-                ]
-                self.wait_for_module("json")
-                self.log(f"Messages sent to LLM:\n{json.dumps(messages, indent=4, ensure_ascii=False)}")
-
-                self.wait_for_module("completion")
-                LLM_response = completion(
-                    model=llm_model,
-                    messages=messages,
-                    num_retries=3,
-                )
-                answer = LLM_response.json(
-                )["choices"][0]["message"]["content"]
-                self.log(f'LLM output: "{answer}"')
-                text = answer
-
-            self.log("Pasting clipboard")
-            pyclip.copy(text)
-            if auto_paste:
-                cont = keyboard.Controller()
-                modifier = keyboard.Key.ctrl if os_type != "Darwin" else keyboard.Key.cmd
-                with cont.pressed(modifier):
-                    cont.press("v")
-                    cont.release("v")
-                if restore_clipboard:
-                    pyclip.copy(clipboard)
-                    self.log("Clipboard restored")
-
-            self.notif("Done")
-            playsound("sounds/Positive.ogg", block=False)
-
-        elif task == "transform_clipboard":
-            self.log(
-                f'Calling LLM with instruction "{text}" and tasked to transform the clipboard'
-            )
-
-            self.wait_for_module("pyclip")
-            try:
-                clipboard = str(pyclip.paste())
-            except Exception as err:
-                raise Exception(
-                        f"Error when loading content of clipboard: {err}")
-
-            if not clipboard:
-                self.notif(self.log("Clipboard is empty, this is not compatible with the task"))
-                raise SystemExit()
-            if isinstance(clipboard, str):
-                self.log(f"Clipboard previous content: '{clipboard}'")
-            elif isinstance(clipboard, bytes):
-                self.log(f"Clipboard previous content is binary")
-
-            assert len(clipboard) < 10000, f"Suspiciously large clipboard content: {len(clipboard)}"
-            assert len(text) < 10000, f"Suspiciously large text content: {len(text)}"
-            self.wait_for_module("completion")
-            LLM_response = completion(
-                model=llm_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": self.system_prompts["transform_clipboard"],
-                    },
-                    {
-                        "role": "user",
-                        "content": f"INPUT_TEXT: '{clipboard}'\n\nINSTRUCTION: '{text}'",
-                    },
-                ],
-            )
-            answer = LLM_response.json()["choices"][0]["message"]["content"]
-            self.log(f'LLM clipboard transformation: "{answer}"')
-
-            self.log("Pasting clipboard")
-            pyclip.copy(answer)
-            self.notif(answer, -1)
-            if auto_paste:
-                cont = keyboard.Controller()
-                modifier = keyboard.Key.ctrl if os_type != "Darwin" else keyboard.Key.cmd
-                with cont.pressed(modifier):
-                    cont.press("v")
-                    cont.release("v")
-                if restore_clipboard:
-                    pyclip.copy(clipboard)
-                    self.log("Clipboard restored")
-
-            playsound("sounds/Positive.ogg", block=False)
-
-        elif "voice_chat" in task:
-            if "new" in task:
-                voice_file = cache_dir / f"quick_whisper_chat_{int(time.time())}.txt"
-                self.log(f"Creating new voice chat file: {voice_file}")
-
-                messages = [
-                    {"role": "system", "content": self.system_prompts["voice"]},
-                ]
-
-            elif "continue" in task:
-                voice_files = [
-                    f
-                    for f in cache_dir.iterdir()
-                    if f.name.startswith("quick_whisper_chat_")
-                ]
-                voice_files = sorted(
-                    voice_files, key=lambda x: x.stat().st_ctime)
-                voice_file = voice_files[-1]
-
-                self.log(f"Reusing previous voice chat file: {voice_file}")
-
-                with open(voice_file, "r") as f:
-                    lines = [line.strip() for line in f.readlines()]
-
-                messages = [
-                    {"role": "system", "content": self.system_prompts["voice"]}]
-                role = "assistant"
-                for line in lines:
-                    if not line:
-                        continue
-                    if line == "#####":
-                        role = "user" if role == "assistant" else "assistant"
-                    else:
-                        if role == messages[-1]["role"]:
-                            messages[-1]["content"] += "\n" + line
-                        else:
-                            messages.append({"role": role, "content": line})
-            else:
-                raise ValueError(task)
-
-            messages.append({"role": "user", "content": text})
-
-            self.log(f"Calling LLM with messages: '{messages}'")
-            self.wait_for_module("completion")
-            LLM_response = completion(model=llm_model, messages=messages)
-            answer = LLM_response.json()["choices"][0]["message"]["content"]
-            self.log(f'LLM answer to the chat: "{answer}"')
-            self.notif(answer, -1)
-
-            vocal_file_mp3 = cache_dir / (str(uuid()) + ".mp3")
-            voice_engine = voice_engine if not disable_voice else None
-            if voice_engine == "piper":
-                self.wait_for_module("wave")
-                self.wait_for_module("voice")
-                try:
-                    self.log(f"Synthesizing speech to {vocal_file_mp3}")
-                    with wave.open(vocal_file_mp3, "wb") as wav_file:
-                        answer = answer.replace("!", ".")
-                        answer = answer.replace(". ", ".\n")
-                        voice.synthesize(answer, wav_file)
-
-                    self.log(f"Playing voice file: {vocal_file_mp3}")
-                    playsound(vocal_file_mp3, block=True)
-                except Exception as err:
-                    self.notif(
-                        self.log(f"Error with piper, trying with espeak: '{err}'"))
-                    voice_engine = "espeak"
-
-            if voice_engine == "deepgram":
-                self.wait_for_module("DeepgramClient")
-                try:
-                    deepgram = DeepgramClient(
-                        api_key="",
-                        config=ClientOptionsFromEnv()
-                    )
-                    options = SpeakOptions(
-                        model="aura-asteria-en",
-                    )
-                    response = deepgram.speak.v("1").save(
-                        vocal_file_mp3,
-                        {"text": answer},
-                        options,
-                    )
-                    playsound(vocal_file_mp3, block=True)
-                except Exception as err:
-                    self.notif(
-                        self.log(f"Error with deepgram voice_engine, trying with espeak: '{err}'"))
-                    voice_engine = "espeak"
-
-            if voice_engine == "openai":
-                self.wait_for_module("OpenAI")
-                try:
-                    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-                    response = client.audio.speech.create(
-                        model="tts-1",
-                        voice="echo",
-                        input=answer,
-                        response_format="mp3",
-                        speed=1.3,
-                    )
-                    response.stream_to_file(str(vocal_file_mp3.absolute()))
-                    playsound(vocal_file_mp3, block=True)
-                except Exception as err:
-                    self.notif(
-                        self.log(f"Error with openai voice_engine, trying with espeak: '{err}'"))
-                    voice_engine = "espeak"
-
-            if voice_engine == "espeak":
-                if whisper_lang:
-                    subprocess.run(
-                        ["espeak", "-v", whisper_lang, "-p", "20", "-s", "110", "-z", answer]
-                    )
-                else:
-                    subprocess.run(
-                        ["espeak", "-p", "20", "-s", "110", "-z", answer]
-                    )
-
-            if voice_engine is None:
-                self.log("voice_engine is None: not speaking.")
+                server.serve_forever()
+            except KeyboardInterrupt:
+                self.log("Quitting.", True)
+            finally:
+                self.daemon_socket.unlink(missing_ok=True)
 
-            # Add text and answer to the file
-            with open(voice_file, "a") as f:
-                f.write("\n#####\n")
-                f.write(f"{text}\n")
-                f.write("\n#####\n")
-                f.write(f"{answer}\n")
+    def handle_request(self, line: bytes) -> dict:
+        "run main with the arguments sent by a client and return the status"
+        import inspect
+        try:
+            main_args = json.loads(line)
+            assert isinstance(main_args, dict), f"request must be a dict, not {type(main_args)}"
+            if main_args == {"jobs": True}:
+                return {"status": "ok", "jobs": self.jobs.status()}
+            assert main_args.get("task") in self.allowed_tasks, f"Invalid task {main_args.get('task')} not part of {self.allowed_tasks}"
+            allowed_args = inspect.signature(self.main).parameters
+            unexpected = [k for k in main_args if k not in allowed_args]
+            assert not unexpected, f"Unexpected arguments: {unexpected}"
+        except Exception as err:
+            return {"status": "error", "error": self.log(f"Invalid daemon request: '{err}'")}
+
+        # like for loop_tasks, a path is replaced by its content
+        for k, v in main_args.items():
+            if isinstance(v, str) and k not in self.path_args and Path(v).exists():
+                main_args[k] = Path(v).read_text()
+
+        self.log(f"Daemon request: {main_args}")
+        if main_args["task"] == "list_voice_chats":
+            # printing in main would only reach the daemon's stdout
+            return {"status": "ok", "voice_chats": self.voice_chats()}
+        job = self.jobs.submit(main_args)
+        job.finished.wait()
+        if job.state == "exited":
+            return {"status": "exited", "message": job.error}
+        elif job.state == "failed":
+            return {"status": "error", "error": self.log(f"Error in daemon request: '{job.error}'")}
+        return {"status": "ok", "duration": job.updated - job.created}
+
+    def voice_chats(self) -> List[str]:
+        "one line per stored voice chat: id, date, number of messages and first message"
+        lines = []
+        for conv_id, created, nb_messages, first_message in self.conversations.list():
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(created))
+            lines.append(f"{conv_id}\t{date}\t{nb_messages} messages\t{first_message[:80]!r}")
+        return lines
+
+    def transcribe_chunked(
+        self,
+        pcm: bytes,
+        sample_rate: int,
+        whisper_prompt: Optional[str],
+        whisper_lang: Optional[str],
+        custom_transcription_url: Optional[str],
+        ) -> str:
+        "split a long recording at silences and transcribe the chunks concurrently"
+        chunks = VoiceActivityDetector(sample_rate).split(pcm, self.parallel_chunk_seconds)
+        self.log(f"Transcribing {len(chunks)} chunks with {self.transcription_workers} workers")
+        texts = [None] * len(chunks)
+
+        def transcribe_chunk(i: int) -> str:
+            prompt = whisper_prompt
+            if i and texts[i - 1]:
+                # give the end of the previous chunk as context
+                tail = " ".join(texts[i - 1].split()[-30:])
+                prompt = f"{whisper_prompt} {tail}" if whisper_prompt else tail
+            texts[i] = self.transcribe(
+                pcm=chunks[i],
+                sample_rate=sample_rate,
+                whisper_prompt=prompt,
+                whisper_lang=whisper_lang,
+                custom_transcription_url=custom_transcription_url,
+            ).strip()
+            return texts[i]
 
-        self.log("Done.")
+        with ThreadPoolExecutor(max_workers=self.transcription_workers) as executor:
+            results = list(executor.map(transcribe_chunk, range(len(chunks))))
+        text = " ".join(t for t in results if t)
+        assert text, "Empty text from chunked transcription"
+        return text
 
     def loop(self) -> None:
         "run continuously, waiting for shift to be pressed enough times"
@@ -824,8 +1756,12 @@ class QuickWhisper:
     def on_release(
         self,
         key,  # : keyboard.Key
+        injected: bool = False,
         ) -> Union[bool, None]:
         "triggered when a key is released"
+        if injected:
+            # sent by pynput's Controller when pasting, not by the user
+            return
         if key in self.loop_key_triggers:
             if self.verbose:
                 print("Released loop key trigger")
@@ -879,7 +1815,8 @@ class QuickWhisper:
                 self._notif(f"Invalid task in '{main_args}'")
                 return False
 
-            self.main(**main_args)
+            job = self.jobs.submit(main_args)
+            self.log(f"Queued job {job.id}")
             return False
 
         else:
@@ -944,58 +1881,1653 @@ class QuickWhisper:
             self.stop_recording()
             raise SystemExit()
 
-    def wait_for_module(self, module: str, timeout: int = 10) -> None:
-        "sleep while the module is not imported by importer"
-        cnt = 0
-        start = time.time()
-        while time.time() - start < timeout:
-            if module in globals():
-                return
-            assert self.import_thread.is_alive(), "Importer thread not running, it encountered an error"
-            time.sleep(0.001)
-            cnt += 1
-            if self.verbose and cnt % 10 == 0:
-                print(f"WAITING FOR {module}")
-        raise Exception(f"Module not imported in time: {module}")
+    def paste(self, text: str, auto_paste: bool) -> None:
+        "copy the text to the clipboard and press ctrl+v (cmd+v on mac) if auto_paste"
+        self.wait_for_module("pyclip")
+        pyclip.copy(text)
+        if auto_paste:
+            cont = keyboard.Controller()
+            modifier = keyboard.Key.ctrl if os_type != "Darwin" else keyboard.Key.cmd
+            with cont.pressed(modifier):
+                cont.press("v")
+                cont.release("v")
+
+    def paste_stream(self, deltas: Iterator[str], keep_answer: bool = True) -> str:
+        """
+        paste the LLM output by batches of self.stream_paste_seconds while it
+        is generated, then leave it whole in the clipboard if keep_answer and
+        return it
+        """
+        answer = ""
+        batch = ""
+        last_paste = time.time()
+        for delta in deltas:
+            answer += delta
+            batch += delta
+            if batch and time.time() - last_paste >= self.stream_paste_seconds:
+                self.paste(batch, auto_paste=True)
+                batch = ""
+                last_paste = time.time()
+        if batch:
+            self.paste(batch, auto_paste=True)
+        # the target application may paste asynchronously, replacing the
+        # clipboard right away would paste the whole answer again
+        time.sleep(self.paste_settle_seconds)
+        if keep_answer:
+            pyclip.copy(answer)
+        return answer
+
+    def select_back(self, nb_chars: int) -> None:
+        "select the nb_chars characters before the cursor with shift+left"
+        cont = keyboard.Controller()
+        with cont.pressed(keyboard.Key.shift):
+            for _ in range(nb_chars):
+                cont.press(keyboard.Key.left)
+                cont.release(keyboard.Key.left)
+
+    def wait_for_module(self, module: str, timeout: int = 30) -> None:
+        "block until the name is imported by self.imports"
+        self.imports.wait(module, timeout)
+
+    def wait_for_audio_io(self) -> None:
+        "sounddevice is used for recording and playing except on linux"
+        if os_type != "Linux":
+            self.wait_for_module("sd")
 
     def stop_recording(self) -> None:
         self.log("Trying to stop recording")
-        if os_type == "Linux":
-            self.wait_for_module("subprocess")
-            if hasattr(self, "rec_process"):
-                children = psutil.Process(self.rec_process.pid).children()
-                assert children, "It seems the rec_process has no children"
-                for child in children:
-                    child.terminate()
-
-                delattr(self, "rec_process")
-        else:
-            self.wait_for_module("audio_recorder")
-            audio_recorder.stop()
+        if hasattr(self, "recorder"):
+            self.recorder.stop()
+            delattr(self, "recorder")
         return
 
 
-def importer(import_list: List[str]) -> None:
+class Job:
+    "a task triggered in the loop or by the daemon, and its progress"
+
+    def __init__(self, job_id: int, args: dict):
+        self.id = job_id
+        self.args = args
+        self.state = "queued"
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self.output_released = False
+        self.finished = threading.Event()
+
+
+class JobScheduler:
+    """
+    Runs the tasks as jobs in worker threads so that a new recording can
+    start while the previous jobs are still being transcribed or sent to the
+    LLM. Only one job records at a time (capture_turn) and the output of the
+    jobs (paste, speech, voice chat history) happens in the order they were
+    submitted (output_turn). Outside of a job, both turns are immediate.
+    """
+    history = 20  # number of finished jobs kept for status()
+
+    def __init__(self, run: Callable[..., None], max_workers: int, log: Callable):
+        self.run = run
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.capture_lock = threading.Lock()
+        self.output_changed = threading.Condition()
+        self.next_output = 0  # id of the job whose output comes next
+        self.jobs = OrderedDict()
+        self.counter = 0
+        self.local = threading.local()
+
+    @property
+    def current(self) -> Optional[Job]:
+        return getattr(self.local, "job", None)
+
+    def submit(self, args: dict) -> Job:
+        with self.output_changed:
+            job = Job(self.counter, args)
+            self.counter += 1
+            self.jobs[job.id] = job
+            for old in list(self.jobs.values())[:-self.history]:
+                if old.finished.is_set() and old.id < self.next_output:
+                    del self.jobs[old.id]
+        self.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: Job) -> None:
+        self.local.job = job
+        try:
+            self.run(**job.args)
+            self.set_state("done")
+        except SystemExit as err:
+            self.set_state("exited", str(err))
+        except Exception as err:
+            self.set_state("failed", str(err))
+            self.log(f"Error in job {job.id}: '{err}'")
+        finally:
+            self.local.job = None
+            self.release_output(job)
+            job.finished.set()
+
+    def set_state(self, state: str, error: Optional[str] = None) -> None:
+        job = self.current
+        if job is None:
+            return
+        job.state = state
+        job.error = error
+        job.updated = time.time()
+        self.log(f"Job {job.id}: {state}")
+
+    @contextmanager
+    def capture_turn(self):
+        "wait until no other job is recording"
+        self.set_state("waiting to record")
+        with self.capture_lock:
+            self.set_state("recording")
+            yield
+        self.set_state("transcribing")
+
+    @contextmanager
+    def output_turn(self):
+        "wait until the previous jobs are done with their output"
+        job = self.current
+        if job is None:
+            yield
+            return
+        self.set_state("waiting for output")
+        with self.output_changed:
+            self.output_changed.wait_for(lambda: self.next_output == job.id)
+        self.set_state("output")
+        try:
+            yield
+        finally:
+            self.release_output(job)
+
+    def release_output(self, job: Job) -> None:
+        "let the next jobs output, also called for jobs that exit early"
+        with self.output_changed:
+            job.output_released = True
+            while self.next_output in self.jobs and self.jobs[self.next_output].output_released:
+                self.next_output += 1
+            self.output_changed.notify_all()
+
+    def status(self) -> List[dict]:
+        with self.output_changed:
+            jobs = list(self.jobs.values())
+        return [
+            {
+                "id": job.id,
+                "task": job.args.get("task"),
+                "state": job.state,
+                "error": job.error,
+                "seconds": round(job.updated - job.created, 2),
+            }
+            for job in jobs
+        ]
+
+
+class ImportRegistry:
     """
-    multithreading to import module and reduce startup time
-    source: https://stackoverflow.com/questions/46698837/can-i-import-modules-from-thread-in-python
+    Imports the dependencies in the background on a small pool of threads,
+    in the order of their priority (lower is needed sooner) so that light
+    modules needed right away like keyboard and playsound are not held up
+    by heavy ones like litellm or torch. Each imported name has an event
+    that is set once the import finished, successfully or not.
+    Parallel imports are safe because python has a lock per module.
     """
-    global playsound, notification, subprocess, sg, keyboard, torchaudio, sf, completion, transcription, pyclip, json, piper, wave, voice, OpenAI, DeepgramClient, PrerecordedOptions, ClientOptionsFromEnv, SpeakOptions
-    for import_str in import_list:
+
+    def __init__(self, max_workers: int = 3):
+        self.max_workers = max_workers
+        self.pending = []  # (priority, statement, fallback)
+        self.events = {}
+        self.errors = {}
+
+    @staticmethod
+    def names(statement: str) -> List[str]:
+        "names bound in the globals by an import statement"
+        if statement.startswith("from "):
+            imported = statement.split(" import ", 1)[1].split(",")
+        else:
+            imported = [statement[len("import "):]]
+        names = []
+        for name in imported:
+            name = name.strip()
+            if " as " in name:
+                name = name.split(" as ")[1]
+            names.append(name.split(".")[0])
+        return names
+
+    def add(self, statement: str, priority: int, fallback: Optional[str] = None) -> None:
+        "schedule an import, fallback is tried if the statement fails"
+        for name in self.names(statement):
+            self.events.setdefault(name, threading.Event())
+        self.pending.append((priority, statement, fallback))
+
+    def start(self) -> None:
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for _, statement, fallback in sorted(self.pending, key=lambda pending: pending[0]):
+            executor.submit(self._import, statement, fallback)
+        executor.shutdown(wait=False)
+        self.pending = []
+
+    def _import(self, statement: str, fallback: Optional[str]) -> None:
+        names = self.names(statement)
+        start = time.time()
         if DEBUG_IMPORT:
-            print(f"Importing: '{import_str}'")
+            print(f"Importing: '{statement}'")
         try:
-            exec(import_str, globals())
+            if not all(name in globals() for name in names):  # imported by __main__
+                try:
+                    exec(statement, globals())
+                except Exception as err:
+                    if fallback is None:
+                        raise
+                    if DEBUG_IMPORT:
+                        print(f"Error when importing '{statement}', trying '{fallback}': '{err}'")
+                    exec(fallback, globals())
         except Exception as err:
-            if "playsound" in import_str:
+            for name in names:
+                self.errors[name] = f"Error when importing module '{statement}': '{err}'"
+        finally:
+            for name in names:
+                self.events[name].set()
+        if DEBUG_IMPORT:
+            print(f"Imported '{statement}' in {time.time() - start:.2f}s")
+
+    def wait(self, name: str, timeout: float) -> None:
+        "block until name is imported, raise if its import failed"
+        if name not in self.events and name in globals():
+            return  # imported by __main__
+        assert name in self.events, f"Module {name} was not scheduled for import"
+        if not self.events[name].wait(timeout):
+            raise Exception(f"Module not imported in time: {name}")
+        if name in self.errors:
+            raise Exception(self.errors[name])
+
+
+class ConnectionPool:
+    """
+    Shared HTTP clients with keep-alive for every backend, so that TCP and
+    TLS connections are reused between calls instead of being opened again
+    for each request.
+    """
+    hosts = {
+        "openai": "https://api.openai.com/v1",
+        "deepgram": "https://api.deepgram.com/v1",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, name: str, factory: Callable):
+        "return the client called name, creating it with factory on first use"
+        with self.lock:
+            if name not in self.clients:
+                self.clients[name] = factory()
+            return self.clients[name]
+
+    def session(self) -> requests.Session:
+        "requests session used for custom_transcription_url"
+        def factory():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            return session
+        return self.get("session", factory)
+
+    def httpx_client(self):
+        "httpx client shared by litellm and the openai client"
+        def factory():
+            import httpx
+            return httpx.Client(
+                timeout=httpx.Timeout(600, connect=10),
+                limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300),
+            )
+        return self.get("httpx", factory)
+
+    def openai_client(self):
+        def factory():
+            from openai import OpenAI
+            return OpenAI(api_key=os.environ["OPENAI_API_KEY"], http_client=self.httpx_client())
+        return self.get("openai", factory)
+
+    def configure_litellm(self) -> None:
+        "make the openai clients created by litellm use the shared httpx client"
+        import litellm
+        if litellm.client_session is None:
+            litellm.client_session = self.httpx_client()
+
+    def warmup(self, urls) -> None:
+        "open the connections in the background so they are ready when needed"
+        for url in urls:
+            threading.Thread(target=self._warmup, args=(url,), daemon=True).start()
+
+    def _warmup(self, url: str) -> None:
+        # failures are expected (eg 401 or 404), only the handshake matters
+        try:
+            if url == self.hosts["openai"]:
+                self.configure_litellm()
+                self.httpx_client().head(url)
+            elif url == self.hosts["deepgram"]:
+                # the deepgram sdk creates its own http client for each call
+                # so only the DNS resolution can be done ahead of time
+                import socket
+                socket.getaddrinfo("api.deepgram.com", 443)
+            else:
+                self.session().head(url, timeout=5)
+        except Exception as err:
+            if DEBUG_IMPORT:
+                print(f"Warmup of {url} failed: '{err}'")
+
+
+connection_pool = ConnectionPool()
+
+
+upload_formats = {
+    # name: (extension, soundfile format, soundfile subtype)
+    "wav": ("wav", None, None),
+    "flac": ("flac", "FLAC", "PCM_16"),
+    "opus": ("ogg", "OGG", "OPUS"),
+}
+
+
+def encode_audio(pcm: bytes, sample_rate: int, upload_format: str) -> Tuple[bytes, str]:
+    "encode 16 bits mono PCM and return the encoded bytes and a filename"
+    extension, sf_format, subtype = upload_formats[upload_format]
+    if upload_format == "wav":
+        return pcm_to_wav(pcm, sample_rate), "audio.wav"
+    import numpy as np
+    import soundfile as sf
+    buf = io.BytesIO()
+    sf.write(
+        buf,
+        np.frombuffer(pcm, dtype=np.int16),
+        sample_rate,
+        format=sf_format,
+        subtype=subtype,
+    )
+    return buf.getvalue(), f"audio.{extension}"
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int) -> bytes:
+    "prepend a wav header to raw 16 bits mono PCM, the samples are copied once"
+    import struct
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + len(pcm), b"WAVE",
+        b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b"data", len(pcm),
+    )
+    return header + pcm
+
+
+class RingBuffer:
+    "fixed size store of the most recent int16 samples, backed by an array"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data = array("h", bytes(2 * size))
+        self.pos = 0
+        self.filled = 0
+
+    def write(self, block: bytes) -> None:
+        samples = array("h")
+        samples.frombytes(block)
+        n = len(samples)
+        if n >= self.size:
+            self.data[:] = samples[-self.size:]
+            self.pos = 0
+            self.filled = self.size
+            return
+        end = self.pos + n
+        if end <= self.size:
+            self.data[self.pos:end] = samples
+        else:
+            first = self.size - self.pos
+            self.data[self.pos:] = samples[:first]
+            self.data[:n - first] = samples[first:]
+        self.pos = end % self.size
+        self.filled = min(self.size, self.filled + n)
+
+    def last(self, n: int) -> bytes:
+        "return the n most recent samples as PCM"
+        n = min(n, self.filled)
+        start = (self.pos - n) % self.size
+        if start + n <= self.size:
+            return self.data[start:start + n].tobytes()
+        return (self.data[start:] + self.data[:start + n - self.size]).tobytes()
+
+
+class PCMRecorder:
+    """
+    Records raw 16 bits mono PCM from the microphone into memory, without
+    any file or encoding. On Linux the samples are read from the stdout of
+    sox's rec, elsewhere from an in process sounddevice stream.
+    Each block is handed to the functions in self.listeners as soon as
+    it is read.
+
+    If ring_seconds is set, only the last ring_seconds of audio are kept in
+    a RingBuffer, this is used for the always on capture of the loop.
+    If source is set, no new capture is started: the recording subscribes
+    to the source, starting with the last preroll seconds of its ring.
+    Without a ring, blocks past max_seconds are dropped and on_max_duration
+    is called once.
+    """
+    block_ms = 20
+    max_seconds = 3600
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        ring_seconds: float = 0,
+        source: Optional["PCMRecorder"] = None,
+        preroll: float = 0,
+        ):
+        self.sample_rate = source.sample_rate if source else sample_rate
+        self.pcm = bytearray()
+        self.ring = RingBuffer(int(ring_seconds * self.sample_rate)) if ring_seconds else None
+        self.source = source
+        self.preroll = preroll
+        self.listeners = []
+        self.on_max_duration = None
+        self.capped = False
+        self.lock = threading.Lock()
+        self.process = None
+        self.stream = None
+        self.thread = None
+
+    @property
+    def duration(self) -> float:
+        return len(self.pcm) / 2 / self.sample_rate
+
+    @property
+    def running(self) -> bool:
+        if self.process is not None:
+            return self.process.poll() is None
+        return self.stream is not None and self.stream.active
+
+    def start(self) -> None:
+        if self.source is not None:
+            with self.source.lock:
+                if self.preroll:
+                    self._on_block(self.source.ring.last(int(self.preroll * self.sample_rate)))
+                self.source.listeners.append(self._on_block)
+        elif os_type == "Linux":
+            import subprocess
+            self.process = subprocess.Popen(
+                [
+                    "rec", "-q",
+                    "-t", "raw",
+                    "-r", str(self.sample_rate),
+                    "-c", "1",
+                    "-b", "16",
+                    "-e", "signed-integer",
+                    "-",
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self.thread = threading.Thread(target=self._read, daemon=True)
+            self.thread.start()
+        else:
+            import sounddevice as sd
+            self.stream = sd.RawInputStream(
+                samplerate=self.sample_rate,
+                channels=1,
+                dtype="int16",
+                blocksize=self.sample_rate * self.block_ms // 1000,
+                callback=lambda indata, frames, time_info, status: self._on_block(bytes(indata)),
+            )
+            self.stream.start()
+
+    def _read(self) -> None:
+        block_size = self.sample_rate * 2 * self.block_ms // 1000
+        while True:
+            block = self.process.stdout.read(block_size)
+            if not block:
+                break
+            self._on_block(block)
+            if self.capped:
+                self.process.terminate()
+                break
+
+    def _on_block(self, block: bytes) -> None:
+        with self.lock:
+            if self.ring is not None:
+                self.ring.write(block)
+            elif self.duration >= self.max_seconds:
+                if not self.capped:
+                    self.capped = True
+                    if self.on_max_duration is not None:
+                        self.on_max_duration()
+                return
+            else:
+                self.pcm.extend(block)
+            for listener in self.listeners:
+                listener(block)
+
+    def stop(self) -> None:
+        if self.source is not None:
+            with self.source.lock:
+                self.source.listeners.remove(self._on_block)
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.thread is not None:
+            self.thread.join()
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+
+
+class AudioCleaner:
+    """
+    NumPy/SciPy implementation of the sox effects used in
+    QuickWhisper.sox_cleanup, working on in memory PCM. Only the effects
+    and options used there are supported: highpass and lowpass with one or
+    two poles, norm, silence and pad. The filters use the same
+    coefficients as sox's biquads.
+
+    Either call clean on the whole recording, or call feed on each block
+    while it is being captured then finish: the leading filters are then
+    applied incrementally with their state kept between blocks, and only
+    the cheap effects that need the whole signal (norm, silence, pad) are
+    left for finish.
+    """
+    frame_ms = 20  # window used to measure the level for silence
+
+    def __init__(self, effects: List[List[str]], sample_rate: int):
+        self.sample_rate = sample_rate
+        self.effects = [self.parse(effect) for effect in effects]
+
+        # number of effects that can be applied block by block
+        self.n_streaming = 0
+        while self.n_streaming < len(self.effects) and self.effects[self.n_streaming][0] == "filter":
+            self.n_streaming += 1
+        self.states = [None] * self.n_streaming
+        self.blocks = []
+
+    def parse(self, effect: List[str]) -> tuple:
+        name, args = effect[0], list(effect[1:])
+        if name in ("highpass", "lowpass"):
+            poles = 2
+            if args[0] in ("-1", "-2"):
+                poles = int(args.pop(0)[1])
+            return ("filter", self.coefficients(name, poles, float(args[0])))
+        elif name == "norm":
+            level = float(args[0]) if args else 0.0
+            return ("norm", 10 ** (level / 20))
+        elif name == "silence":
+            leave = args[0] == "-l"
+            if leave:
+                args.pop(0)
+            above_periods, above_duration, above_threshold = args[:3]
+            below_periods, below_duration, below_threshold = args[3:6]
+            assert int(above_periods) in (0, 1), "only 0 or 1 above_periods is supported"
+            assert int(below_periods) == -1, "only -1 below_periods is supported"
+            return ("silence", dict(
+                trim_start=int(above_periods) == 1,
+                start_threshold=self.threshold(above_threshold),
+                max_silence=float(below_duration),
+                stop_threshold=self.threshold(below_threshold),
+                leave=leave,
+            ))
+        elif name == "pad":
+            start = args[0].split("@")
+            assert len(start) == 1 or float(start[1]) == 0, "pad is only supported at the start"
+            return ("pad", int(float(start[0]) * self.sample_rate))
+        raise ValueError(f"Unsupported sox effect for AudioCleaner: {effect}")
+
+    def coefficients(self, name: str, poles: int, freq: float) -> tuple:
+        "same formulas as sox's biquads.c"
+        import numpy as np
+        w0 = 2 * np.pi * freq / self.sample_rate
+        if poles == 1:
+            a1 = -np.exp(-w0)
+            if name == "lowpass":
+                b = [1 + a1, 0]
+            else:
+                b = [(1 - a1) / 2, -(1 - a1) / 2]
+            return np.array(b), np.array([1, a1])
+        alpha = np.sin(w0) / (2 * np.sqrt(0.5))  # q of a butterworth
+        cos = np.cos(w0)
+        if name == "lowpass":
+            b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+        else:
+            b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+        return np.array(b) / a[0], np.array(a) / a[0]
+
+    @staticmethod
+    def threshold(value: str) -> float:
+        if value.endswith("%"):
+            return float(value[:-1]) / 100
+        return float(value)
+
+    def clean(self, pcm: bytes) -> bytes:
+        "apply every effect to 16 bits PCM and return 16 bits PCM"
+        import numpy as np
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        for kind, params in self.effects:
+            samples = self.apply(kind, params, samples)
+        return (samples.clip(-1, 1) * 32767).astype(np.int16).tobytes()
+
+    def feed(self, block: bytes) -> None:
+        "filter a captured block, keeping the state of the filters between blocks"
+        import numpy as np
+        from scipy.signal import lfilter
+        samples = np.frombuffer(block, dtype=np.int16).astype(np.float32) / 32768
+        for i in range(self.n_streaming):
+            b, a = self.effects[i][1]
+            if self.states[i] is None:
+                self.states[i] = np.zeros(max(len(a), len(b)) - 1)
+            samples, self.states[i] = lfilter(b, a, samples, zi=self.states[i])
+        self.blocks.append(samples.astype(np.float32))
+
+    def finish(self) -> bytes:
+        "apply the remaining effects to the fed blocks and return 16 bits PCM"
+        import numpy as np
+        samples = np.concatenate(self.blocks) if self.blocks else np.zeros(0, dtype=np.float32)
+        for kind, params in self.effects[self.n_streaming:]:
+            samples = self.apply(kind, params, samples)
+        return (samples.clip(-1, 1) * 32767).astype(np.int16).tobytes()
+
+    def apply(self, kind: str, params, samples):
+        import numpy as np
+        from scipy.signal import lfilter
+        if kind == "filter":
+            return lfilter(params[0], params[1], samples).astype(np.float32)
+        elif kind == "norm":
+            peak = np.abs(samples).max() if len(samples) else 0
+            return samples * (params / peak) if peak else samples
+        elif kind == "silence":
+            return self.remove_silence(samples, **params)
+        elif kind == "pad":
+            return np.concatenate([np.zeros(params, dtype=np.float32), samples])
+        raise ValueError(kind)
+
+    def remove_silence(
+        self,
+        samples,
+        trim_start: bool,
+        start_threshold: float,
+        max_silence: float,
+        stop_threshold: float,
+        leave: bool,
+        ):
+        "trim the leading silence and shorten the silences above max_silence"
+        import numpy as np
+        frame = self.sample_rate * self.frame_ms // 1000
+        n_frames = len(samples) // frame
+        if not n_frames:
+            return samples
+        frames = samples[:n_frames * frame].reshape(n_frames, frame)
+        rms = np.sqrt(np.mean(frames ** 2, axis=1))
+
+        keep = np.ones(n_frames, dtype=bool)
+        if trim_start:
+            loud = np.flatnonzero(rms > start_threshold)
+            if not len(loud):
+                return samples[:0]
+            keep[:loud[0]] = False
+
+        # find the runs of silent frames
+        silent = np.concatenate([[False], rms < stop_threshold, [False]])
+        edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+        max_frames = int(max_silence * 1000 / self.frame_ms)
+        for start, end in zip(edges[::2], edges[1::2]):
+            if end - start > max_frames:
+                keep[start + (max_frames if leave else 0):end] = False
+
+        kept = frames[keep].reshape(-1)
+        return np.concatenate([kept, samples[n_frames * frame:]])
+
+
+class VoiceActivityDetector:
+    """
+    Lightweight voice activity detection based on the energy and the zero
+    crossing rate of 20ms frames. A frame is voiced if its rms is well above
+    the noise floor and it is not noise like (too many zero crossings),
+    unless it is very loud.
+
+    feed is meant to be a PCMRecorder listener and calls on_auto_stop once
+    voice was heard then auto_stop_ms of silence followed.
+    trim removes the leading and trailing silences of a whole recording.
+    """
+    frame_ms = 20
+    min_rms = 200  # int16 rms under which a frame is always silent
+    noise_factor = 3  # how far above the noise floor voice must be
+    max_zcr = 0.35  # frames crossing zero more often are considered noise
+    trim_margin_ms = 300  # silence kept around the voice when trimming
+
+    def __init__(
+        self,
+        sample_rate: int,
+        auto_stop_ms: int = 0,
+        on_auto_stop: Optional[Callable] = None,
+        ):
+        self.sample_rate = sample_rate
+        self.frame = sample_rate * self.frame_ms // 1000
+        self.auto_stop_ms = auto_stop_ms
+        self.on_auto_stop = on_auto_stop
+        self.noise_floor = None
+        self.heard_voice = False
+        self.silent_ms = 0
+        self.stopped = False
+
+    def features(self, samples):
+        "rms and zero crossing rate of each frame"
+        import numpy as np
+        n_frames = len(samples) // self.frame
+        frames = samples[:n_frames * self.frame].reshape(n_frames, self.frame).astype(np.float32)
+        rms = np.sqrt(np.mean(frames ** 2, axis=1))
+        zcr = np.mean(np.abs(np.diff(np.sign(frames), axis=1)) > 0, axis=1)
+        return rms, zcr
+
+    def is_voice(self, rms, zcr, noise_floor):
+        import numpy as np
+        threshold = np.maximum(self.min_rms, noise_floor * self.noise_factor)
+        return (rms > threshold) & ((zcr < self.max_zcr) | (rms > 2 * threshold))
+
+    def feed(self, block: bytes) -> None:
+        "called by PCMRecorder for each captured block"
+        import numpy as np
+        rms, zcr = self.features(np.frombuffer(block, dtype=np.int16))
+        for r, z in zip(rms, zcr):
+            # the floor follows quiet frames and rises slowly otherwise
+            self.noise_floor = r if self.noise_floor is None else min(r, self.noise_floor * 1.005 + 0.1)
+            if self.is_voice(r, z, self.noise_floor):
+                self.heard_voice = True
+                self.silent_ms = 0
+            else:
+                self.silent_ms += self.frame_ms
+        if (
+            self.auto_stop_ms
+            and self.heard_voice
+            and not self.stopped
+            and self.silent_ms >= self.auto_stop_ms
+        ):
+            self.stopped = True
+            if self.on_auto_stop is not None:
+                self.on_auto_stop()
+
+    def trim(self, pcm: bytes) -> bytes:
+        "remove the leading and trailing silences, keeping a small margin"
+        import numpy as np
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        rms, zcr = self.features(samples)
+        if not len(rms):
+            return pcm
+        voiced = np.flatnonzero(self.is_voice(rms, zcr, np.percentile(rms, 10)))
+        if not len(voiced):
+            return pcm
+        margin = self.trim_margin_ms // self.frame_ms
+        start = max(0, voiced[0] - margin) * self.frame
+        end = min(len(rms), voiced[-1] + 1 + margin) * self.frame
+        if voiced[-1] + 1 + margin >= len(rms):
+            end = len(samples)
+        return pcm[start * 2:end * 2]
+
+    def split(self, pcm: bytes, chunk_seconds: float) -> List[bytes]:
+        "cut the recording in the quietest moment around every chunk_seconds"
+        import numpy as np
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        rms, zcr = self.features(samples)
+        if not len(rms):
+            return [pcm]
+        chunk_frames = int(chunk_seconds * 1000 / self.frame_ms)
+        search = chunk_frames // 4
+        # smooth so that a cut lands in a pause and not between two syllables
+        smooth = np.convolve(rms, np.ones(10) / 10, mode="same")
+        cuts = [0]
+        while len(rms) - cuts[-1] > chunk_frames + search:
+            low = cuts[-1] + chunk_frames - search
+            high = cuts[-1] + chunk_frames + search
+            cuts.append(low + int(np.argmin(smooth[low:high])))
+        cuts.append(len(rms))
+
+        voiced = self.is_voice(rms, zcr, np.percentile(rms, 10))
+        chunks = []
+        for start, end in zip(cuts, cuts[1:]):
+            if not voiced[start:end].any():
+                continue
+            end = len(samples) if end == len(rms) else end * self.frame
+            chunks.append(pcm[start * self.frame * 2:end * 2])
+        return chunks or [pcm]
+
+
+def cache_prompt_prefix(messages: List[dict], llm_model: str) -> List[dict]:
+    """
+    openai and deepseek cache the prompt prefixes by themselves, anthropic
+    models need cache_control markers: they are put on the system messages
+    and on the message before the new user message so that the history of
+    the voice chats is cached too. At most 4 markers are allowed.
+    """
+    if "claude" not in llm_model and not llm_model.startswith("anthropic/"):
+        return messages
+    marked = list(range(len(messages) - 1))
+    marked = [i for i in marked if messages[i]["role"] == "system"][:3] + marked[-1:]
+    messages = [dict(message) for message in messages]
+    for i in sorted(set(marked)):
+        if isinstance(messages[i]["content"], str):
+            messages[i]["content"] = [{
+                "type": "text",
+                "text": messages[i]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }]
+    return messages
+
+
+class BackendHealth:
+    "recent latencies and outcomes of a transcription backend"
+    window = 50  # number of latencies and outcomes kept
+
+    def __init__(self):
+        # per second of audio so that short and long recordings can be
+        # compared, the fixed cost of a request counts as one second
+        self.latencies = deque(maxlen=self.window)
+        self.outcomes = deque(maxlen=self.window)
+        self.consecutive_failures = 0
+        self.open = False  # circuit breaker
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def latency(self, percentile: float) -> Optional[float]:
+        "latency per second of audio at that percentile, None if unknown"
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+class TranscriptionRouter:
+    """
+    Sends the audio to an ordered list of transcription backends. The first
+    healthy backend is used and the next one is tried if it fails, or if
+    hedging is enabled and it is slower than usual.
+    A backend that fails failure_threshold times in a row, or more than half
+    of the time, has its circuit opened: it is skipped (or only tried when
+    no backend is healthy) and a background thread probes its url every
+    probe_interval seconds, in-process backends are simply given another
+    chance. Once it answers, the circuit is half open: it is
+    used again but a single failure opens it again.
+    """
+    failure_threshold = 3
+    min_samples = 5  # the default deadline is used until then
+    probe_interval = 10
+    unhedged = ("local",)  # runs in-process: a losing request can't be cancelled and keeps the cores busy
+
+    def __init__(self, backends: List[str], urls: dict, log: Callable):
+        self.backends = backends
+        self.urls = urls
+        self.log = log
+        self.health = {backend: BackendHealth() for backend in ("local", "custom", "deepgram", "openai")}
+        self.lock = threading.Lock()
+        self.prober = None
+
+    def order(self, custom_transcription_url: Optional[str] = None) -> List[str]:
+        "backends to try, healthy ones first; a custom url given for a task is tried first"
+        backends = list(self.backends)
+        if custom_transcription_url and "custom" not in backends:
+            backends.insert(0, "custom")
+        with self.lock:
+            return sorted(backends, key=lambda backend: self.health[backend].open)
+
+    def deadline(self, backend: str, duration: float, percentile: float) -> float:
+        "seconds after which a request for that much audio is unusually slow"
+        health = self.health[backend]
+        with self.lock:
+            latency = health.latency(percentile) if len(health.latencies) >= self.min_samples else None
+        if latency is None:
+            return 2 + 0.2 * duration
+        return latency * max(duration, 1)
+
+    def success(self, backend: str, latency: float, duration: float) -> None:
+        with self.lock:
+            health = self.health[backend]
+            health.latencies.append(latency / max(duration, 1))
+            health.outcomes.append(True)
+            health.consecutive_failures = 0
+
+    def failure(self, backend: str, err: Exception) -> None:
+        with self.lock:
+            health = self.health[backend]
+            health.outcomes.append(False)
+            health.consecutive_failures += 1
+            if health.open or not (
+                health.consecutive_failures >= self.failure_threshold
+                or (len(health.outcomes) >= 2 * self.min_samples and health.error_rate > 0.5)
+            ):
+                return
+            health.open = True
+            if self.prober is None:
+                self.prober = threading.Thread(target=self.probe, daemon=True)
+                self.prober.start()
+        self.log(
+            f"Opening the circuit of transcription backend {backend} after "
+            f"{health.consecutive_failures} failures in a row ({health.error_rate:.0%} "
+            f"of errors), last error: '{err}'"
+        )
+        self.log(f"Transcription backends: {self.status()}")
+
+    def probe(self) -> None:
+        "check the backends with an open circuit until they are all reachable"
+        while True:
+            time.sleep(self.probe_interval)
+            with self.lock:
+                opened = [backend for backend, health in self.health.items() if health.open]
+                if not opened:
+                    self.prober = None
+                    return
+            for backend in opened:
                 try:
-                    exec("from playsound3 import playsound", globals())
-                    continue
+                    # any HTTP answer, even an error code, means it's up,
+                    # in-process backends are simply tried again
+                    if self.urls[backend]:
+                        connection_pool.session().head(self.urls[backend], timeout=2)
                 except Exception as err:
-                    raise Exception(f"Couldn't import either playsound or playsound3: '{err}'")
-            raise Exception(f"Error when importing module '{import_str}': {err}'")
-    if DEBUG_IMPORT:
-        print("Done importing all packages.")
+                    self.log(f"Transcription backend {backend} is still unreachable: '{err}'")
+                    continue
+                with self.lock:
+                    self.health[backend].open = False
+                    self.health[backend].consecutive_failures = self.failure_threshold - 1
+                self.log(f"Transcription backend {backend} is reachable again")
+
+    def status(self) -> dict:
+        "health of each backend, for logging"
+        with self.lock:
+            return {
+                backend: {
+                    "open": self.health[backend].open,
+                    "error_rate": self.health[backend].error_rate,
+                    "median_latency_per_second": self.health[backend].latency(50),
+                }
+                for backend in self.backends
+            }
+
+    def transcribe(
+        self,
+        transcribe: Callable[[str], str],
+        duration: float,
+        hedge_percentile: Optional[float] = None,
+        custom_transcription_url: Optional[str] = None,
+        ) -> str:
+        """
+        call transcribe with the name of each backend until one succeeds,
+        hedging with the next one after the deadline if hedge_percentile
+        """
+        order = self.order(custom_transcription_url)
+        if custom_transcription_url:
+            self.urls["custom"] = custom_transcription_url
+        results = queue.Queue()
+        start = time.time()
+
+        def run(backend: str) -> None:
+            started = time.time()
+            try:
+                text = transcribe(backend)
+            except Exception as err:
+                self.failure(backend, err)
+                results.put((backend, None, err))
+                return
+            self.success(backend, time.time() - started, duration)
+            results.put((backend, text, None))
+
+        # daemon threads: the slower request is abandoned, not waited for
+        threading.Thread(target=run, args=(order[0],), daemon=True).start()
+        launched = 1
+        pending = 1
+        hedged = False
+        errors = []
+        while pending:
+            can_hedge = (
+                hedge_percentile is not None
+                and not hedged
+                and launched < len(order)
+                and order[0] not in self.unhedged
+                and order[launched] not in self.unhedged
+            )
+            deadline = self.deadline(order[0], duration, hedge_percentile) if can_hedge else None
+            try:
+                backend, text, err = results.get(timeout=deadline)
+                pending -= 1
+            except queue.Empty:
+                hedged = True
+                self.log(
+                    f"No transcript from {order[0]} within {deadline:.2f}s, "
+                    f"also sending the audio to {order[launched]}"
+                )
+            else:
+                if err is None:
+                    if backend != order[0]:
+                        self.log(f"Transcript from {backend} after {time.time() - start:.2f}s")
+                    return text
+                errors.append(f"{backend}: {err}")
+                if pending or launched == len(order):
+                    continue
+                self.log(f"Transcription with {backend} failed, trying {order[launched]}: '{err}'")
+            threading.Thread(target=run, args=(order[launched],), daemon=True).start()
+            launched += 1
+            pending += 1
+        raise Exception(f"Transcription failed with every backend: {errors}")
+
+
+class TTSCache:
+    """
+    Content addressed cache of synthesized speech. Each entry is keyed by a
+    hash of (engine, model or voice, speed, text) and the index file maps
+    the key to its file, size and last use. When the total size goes above
+    max_bytes the least recently used entries are deleted.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, log: Callable):
+        self.directory = directory
+        self.log = log
+        self.directory.mkdir(exist_ok=True)
+        self.index_file = directory / "index.json"
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        if self.index_file.exists():
+            import json
+            try:
+                index = json.loads(self.index_file.read_text())
+                for key, entry in sorted(index.items(), key=lambda kv: kv[1]["used"]):
+                    self.entries[key] = entry
+            except Exception as err:
+                self.log(f"Ignoring corrupted speech cache index: '{err}'")
+        self.total = sum(entry["size"] for entry in self.entries.values())
+
+    @staticmethod
+    def key(engine: str, model: str, speed: Optional[float], text: str) -> str:
+        import hashlib
+        import json
+        return hashlib.sha256(json.dumps([engine, model, speed, text]).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Path]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            path = self.directory / entry["file"]
+            if not path.exists():
+                self._remove(key)
+                self._save()
+                return None
+            entry["used"] = time.time()
+            self.entries.move_to_end(key)
+            self._save()
+            return path
+
+    def put(self, key: str, audio: Union[Path, "RawAudio"]) -> Path:
+        "store the audio, files are moved into the cache, return the cached file"
+        if isinstance(audio, RawAudio):
+            path = self.directory / f"{key}.wav"
+            path.write_bytes(pcm_to_wav(audio.pcm, audio.sample_rate))
+        else:
+            path = self.directory / f"{key}{audio.suffix}"
+            audio.replace(path)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key, delete=False)
+            self.entries[key] = {"file": path.name, "size": path.stat().st_size, "used": time.time()}
+            self.total += self.entries[key]["size"]
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+            self._save()
+        return path
+
+    def _remove(self, key: str, delete: bool = True) -> None:
+        entry = self.entries.pop(key)
+        self.total -= entry["size"]
+        if delete:
+            (self.directory / entry["file"]).unlink(missing_ok=True)
+
+    def _save(self) -> None:
+        import json
+        tmp = self.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.entries))
+        tmp.replace(self.index_file)
+
+
+class ConversationStore:
+    """
+    Voice chats stored in SQLite: each message is a row appended to its
+    conversation, so the latest conversation and its messages are found
+    through the primary keys instead of scanning and parsing files.
+    The token count of each message is cached in its row and the messages
+    that were summarized are replaced by the summary of their conversation.
+    The quick_whisper_chat_*.txt files of older versions are imported when
+    the database is created.
+    """
+
+    def __init__(self, path: Path):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        is_new = not path.exists()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(id INTEGER PRIMARY KEY, created REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages "
+                "(id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL "
+                "REFERENCES conversations(id), role TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            self.add_columns("conversations", {
+                "summary": "TEXT",
+                "summarized_until": "INTEGER NOT NULL DEFAULT 0",
+            })
+            self.add_columns("messages", {"tokens": "INTEGER"})
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_conversation "
+                "ON messages (conversation_id, id)"
+            )
+        if is_new:
+            self.import_legacy(path.parent)
+
+    def add_columns(self, table: str, columns: dict) -> None:
+        "add the columns missing from a database created by an older version"
+        existing = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+        for name, definition in columns.items():
+            if name not in existing:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+    def new(self, created: Optional[float] = None) -> int:
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO conversations (created) VALUES (?)",
+                (created or time.time(),),
+            )
+        return cursor.lastrowid
+
+    def latest(self) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute("SELECT MAX(id) FROM conversations").fetchone()
+        return row[0]
+
+    def messages(self, conversation_id: int) -> List[dict]:
+        "the summary as a system note then the messages that were not summarized"
+        with self.lock:
+            conversation = self.db.execute(
+                "SELECT summary, summarized_until FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            assert conversation, f"No voice chat with id {conversation_id}"
+            summary, summarized_until = conversation
+            rows = self.db.execute(
+                "SELECT role, content FROM messages "
+                "WHERE conversation_id = ? AND id > ? ORDER BY id",
+                (conversation_id, summarized_until),
+            ).fetchall()
+        messages = [{"role": role, "content": content} for role, content in rows]
+        if summary:
+            messages.insert(0, {
+                "role": "system",
+                "content": f"Summary of the beginning of the conversation: {summary}",
+            })
+        return messages
+
+    def unsummarized(
+        self,
+        conversation_id: int,
+        count_tokens: Callable[[str], int],
+        ) -> List[Tuple[int, str, str, int]]:
+        "id, role, content and token count of the messages that were not summarized"
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, role, content, tokens FROM messages "
+                "WHERE conversation_id = ? AND id > "
+                "(SELECT summarized_until FROM conversations WHERE id = ?) ORDER BY id",
+                (conversation_id, conversation_id),
+            ).fetchall()
+        missing = [(count_tokens(content), row_id) for row_id, _, content, tokens in rows if tokens is None]
+        if missing:
+            with self.lock, self.db:
+                self.db.executemany("UPDATE messages SET tokens = ? WHERE id = ?", missing)
+            counts = {row_id: tokens for tokens, row_id in missing}
+            rows = [(row_id, role, content, counts.get(row_id, tokens)) for row_id, role, content, tokens in rows]
+        return rows
+
+    def summary(self, conversation_id: int) -> Optional[str]:
+        with self.lock:
+            return self.db.execute(
+                "SELECT summary FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()[0]
+
+    def set_summary(self, conversation_id: int, summary: str, summarized_until: int) -> None:
+        "replace the messages up to the id summarized_until by the summary"
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE conversations SET summary = ?, summarized_until = ? WHERE id = ?",
+                (summary, summarized_until, conversation_id),
+            )
+
+    def append(self, conversation_id: int, role: str, content: str) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                (conversation_id, role, content),
+            )
+
+    def list(self) -> List[Tuple[int, float, int, str]]:
+        "id, creation time, number of messages and first message of each conversation"
+        with self.lock:
+            return self.db.execute(
+                "SELECT c.id, c.created, COUNT(m.id), "
+                "COALESCE((SELECT content FROM messages WHERE conversation_id = c.id ORDER BY id LIMIT 1), '') "
+                "FROM conversations c LEFT JOIN messages m ON m.conversation_id = c.id "
+                "GROUP BY c.id ORDER BY c.id"
+            ).fetchall()
+
+    def import_legacy(self, directory: Path) -> None:
+        "import the #####-delimited quick_whisper_chat_*.txt files"
+        files = sorted(directory.glob("quick_whisper_chat_*.txt"), key=lambda f: f.stat().st_ctime)
+        for file in files:
+            messages = []
+            role = "assistant"
+            for line in file.read_text().splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                if line == "#####":
+                    role = "user" if role == "assistant" else "assistant"
+                elif messages and role == messages[-1][0]:
+                    messages[-1][1] += "\n" + line
+                else:
+                    messages.append([role, line])
+            conversation_id = self.new(created=file.stat().st_ctime)
+            for role, content in messages:
+                self.append(conversation_id, role, content)
+
+
+class TranscriptCache:
+    """
+    Keeps the recordings and their transcripts in the cache dir so that the
+    same audio is never transcribed twice. Transcripts are keyed by a hash
+    of the audio and of the backend, language and prompt used. Only the
+    max_recordings most recent recordings and their transcripts are kept.
+    """
+    max_recordings = 20
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(exist_ok=True)
+        self.last_file = directory / "last_recording.txt"
+
+    def key(
+        self,
+        pcm: bytes,
+        backend: str,
+        whisper_lang: Optional[str],
+        whisper_prompt: Optional[str],
+        ) -> str:
+        import hashlib
+        import json
+        audio_hash = hashlib.sha256(pcm).hexdigest()
+        settings_hash = hashlib.sha256(json.dumps([backend, whisper_lang, whisper_prompt]).encode()).hexdigest()
+        # prefixed by the audio hash so that it is pruned with its recording
+        return f"{audio_hash}_{settings_hash}"
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.directory / f"{key}.txt"
+        return path.read_text() if path.exists() else None
+
+    def put(self, key: str, text: str) -> None:
+        (self.directory / f"{key}.txt").write_text(text)
+
+    def save_recording(self, pcm: bytes, sample_rate: int) -> None:
+        import hashlib
+        name = f"{hashlib.sha256(pcm).hexdigest()}_{sample_rate}.pcm"
+        (self.directory / name).write_bytes(pcm)
+        self.last_file.write_text(name)
+        recordings = sorted(self.directory.glob("*.pcm"), key=lambda f: f.stat().st_mtime)
+        for old in recordings[:-self.max_recordings]:
+            old.unlink(missing_ok=True)
+        kept = {f.stem.split("_")[0] for f in recordings[-self.max_recordings:]}
+        for transcript in self.directory.glob("*.txt"):
+            if transcript != self.last_file and transcript.stem.split("_")[0] not in kept:
+                transcript.unlink(missing_ok=True)
+
+    def last_recording(self) -> Tuple[bytes, int]:
+        "return the PCM and sample rate of the last recording"
+        assert self.last_file.exists(), "No previous recording to reuse"
+        path = self.directory / self.last_file.read_text().strip()
+        assert path.exists(), f"The last recording was deleted: {path}"
+        sample_rate = int(path.stem.split("_")[1])
+        return path.read_bytes(), sample_rate
+
+
+class RawAudio:
+    "raw 16 bits mono PCM and its sample rate"
+
+    def __init__(self, pcm: bytes, sample_rate: int):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+
+
+class AudioSink:
+    """
+    Plays raw 16 bits mono PCM as soon as it is written, through sox's play
+    on Linux and an in process sounddevice stream elsewhere.
+    """
+
+    def __init__(self, sample_rate: int):
+        self.process = None
+        self.stream = None
+        if os_type == "Linux":
+            import subprocess
+            self.process = subprocess.Popen(
+                [
+                    "play", "-q",
+                    "-t", "raw",
+                    "-r", str(sample_rate),
+                    "-e", "signed-integer",
+                    "-b", "16",
+                    "-c", "1",
+                    "-",
+                ],
+                stdin=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        else:
+            import sounddevice as sd
+            self.stream = sd.RawOutputStream(samplerate=sample_rate, channels=1, dtype="int16")
+            self.stream.start()
+
+    def write(self, pcm: bytes) -> None:
+        if self.process is not None:
+            self.process.stdin.write(pcm)
+            self.process.stdin.flush()
+        else:
+            self.stream.write(pcm)
+
+    def close(self) -> None:
+        "wait until everything was played"
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        else:
+            self.stream.stop()
+            self.stream.close()
+
+
+class PiperVoicePool:
+    "least recently used cache of loaded PiperVoice models, keyed by model path"
+
+    def __init__(self, max_size: int = 2):
+        self.max_size = max_size
+        self.voices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, model_path: str):
+        with self.lock:
+            if model_path in self.voices:
+                self.voices.move_to_end(model_path)
+                return self.voices[model_path]
+            from piper.voice import PiperVoice
+            voice = PiperVoice.load(model_path)
+            self.voices[model_path] = voice
+            while len(self.voices) > self.max_size:
+                self.voices.popitem(last=False)
+            return voice
+
+
+def piper_text(text: str) -> str:
+    "piper handles sentences better when each is on its own line"
+    text = text.replace("!", ".")
+    return text.replace(". ", ".\n")
+
+
+class SentenceSplitter:
+    "accumulate streamed tokens and return the sentences once they are complete"
+    pattern = re.compile(r"(?<=[.!?:;])\s+|\n+")
+    min_chars = 20  # shorter sentences are merged with the next one
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, token: str) -> List[str]:
+        self.buffer += token
+        parts = self.pattern.split(self.buffer)
+        # the last part can still be incomplete
+        self.buffer = parts.pop()
+        sentences = []
+        current = ""
+        for part in parts:
+            current = f"{current} {part}".strip()
+            if len(current) >= self.min_chars:
+                sentences.append(current)
+                current = ""
+        if current:
+            self.buffer = f"{current} {self.buffer}"
+        return sentences
+
+    def flush(self) -> List[str]:
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
+
+
+class SpeechPipeline:
+    """
+    Speaks sentences while the next ones are still being generated: each
+    sentence given to say is synthesized in a thread and the audio is played
+    in order in another thread, so that synthesis and playback
+    overlap with the generation.
+    """
+
+    def __init__(
+        self,
+        synthesize: Callable[[str], Union[Path, RawAudio]],
+        play: Callable[[Union[Path, RawAudio]], None],
+        log: Callable,
+        ):
+        self.synthesize = synthesize
+        self.play = play
+        self.log = log
+        self.sentences = queue.Queue()
+        self.files = queue.Queue()
+        self.first_audio = None
+        self.synthesizer = threading.Thread(target=self._synthesize, daemon=True)
+        self.player = threading.Thread(target=self._play, daemon=True)
+        self.synthesizer.start()
+        self.player.start()
+
+    def say(self, sentence: str) -> None:
+        self.sentences.put(sentence)
+
+    def close(self) -> None:
+        "wait until every sentence was played"
+        self.sentences.put(None)
+        self.synthesizer.join()
+        self.player.join()
+
+    def drop_pending(self) -> None:
+        "forget the sentences that are not synthesized or played yet"
+        for pending in (self.sentences, self.files):
+            while True:
+                try:
+                    pending.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _synthesize(self) -> None:
+        while (sentence := self.sentences.get()) is not None:
+            try:
+                self.files.put(self.synthesize(sentence))
+            except Exception as err:
+                self.log(f"Error when synthesizing '{sentence}': '{err}'")
+        self.files.put(None)
+
+    def _play(self) -> None:
+        while (vocal_file := self.files.get()) is not None:
+            if self.first_audio is None:
+                self.first_audio = time.time()
+            try:
+                self.play(vocal_file)
+            except Exception as err:
+                self.log(f"Error when playing {vocal_file}: '{err}'")
+
+
+class DeepgramLiveTranscriber:
+    """
+    Streams the recording to deepgram's live websocket while it is being
+    captured. Sending CloseStream when the recording stops makes deepgram
+    send the last results then close the socket, so the transcript is ready
+    right after the user stops. Only the final results are kept.
+    """
+    url = "wss://api.deepgram.com/v1/listen"
+
+    def __init__(
+        self,
+        sample_rate: int,
+        api_key: str,
+        language: Optional[str] = None,
+        model: str = "nova-3",
+        url: Optional[str] = None,
+        ):
+        from urllib.parse import urlencode
+        params = {
+            "encoding": "linear16",
+            "sample_rate": sample_rate,
+            "channels": 1,
+            "model": model,
+            "punctuate": "true",
+            "smart_format": "true",
+        }
+        if language:
+            params["language"] = language
+        self.uri = f"{url or self.url}?{urlencode(params)}"
+        self.api_key = api_key
+        self.blocks = queue.Queue()  # sent as soon as the socket is open
+        self.transcripts = []
+        self.error = None
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def feed(self, block: bytes) -> None:
+        "called by PCMRecorder for each captured block"
+        self.blocks.put(block)
+
+    def run(self) -> None:
+        import json
+        from websockets.sync.client import connect
+        try:
+            with connect(
+                self.uri,
+                additional_headers={"Authorization": f"Token {self.api_key}"},
+                open_timeout=5,
+                ) as websocket:
+                receiver = threading.Thread(target=self.receive, args=(websocket,), daemon=True)
+                receiver.start()
+                while True:
+                    block = self.blocks.get()
+                    if block is None:
+                        break
+                    websocket.send(block)
+                if self.cancelled:
+                    return  # leaving the with block closes the socket
+                websocket.send(json.dumps({"type": "CloseStream"}))
+                receiver.join()
+        except Exception as err:
+            self.error = err
+
+    def receive(self, websocket) -> None:
+        "collect the final results until deepgram closes the socket"
+        import json
+        try:
+            for message in websocket:
+                result = json.loads(message)
+                if result.get("type") == "Results" and result.get("is_final"):
+                    transcript = result["channel"]["alternatives"][0]["transcript"]
+                    if transcript:
+                        self.transcripts.append(transcript)
+        except Exception as err:
+            self.error = err
+
+    def cancel(self) -> None:
+        "close the socket without waiting for the transcript"
+        self.cancelled = True
+        self.blocks.put(None)
+
+    def finish(self, timeout: float = 10) -> str:
+        "close the stream and return the transcript"
+        self.blocks.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise Exception(f"No answer from deepgram live after {timeout}s")
+        if self.error is not None:
+            raise Exception(f"Deepgram live failed: '{self.error}'")
+        text = " ".join(self.transcripts).strip()
+        assert text, "Empty text from deepgram live"
+        return text
+
+
+class StreamingTranscriber:
+    """
+    Cuts the recording into chunks at silences while it is being captured
+    and sends each chunk for transcription right away, so that only the
+    last chunk is still in flight when the recording stops.
+    """
+    silence_rms = 300  # int16 rms under which a block is considered silent
+    silence_ms = 400  # length of a pause where a chunk can be cut
+
+    def __init__(
+        self,
+        transcribe: Callable[[bytes], str],  # takes raw PCM
+        sample_rate: int,
+        min_chunk_seconds: float,
+        ):
+        self.transcribe = transcribe
+        self.sample_rate = sample_rate
+        self.min_chunk_bytes = int(min_chunk_seconds * sample_rate) * 2
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.futures = []
+        self.chunk = bytearray()
+        self.has_voice = False
+        self.silent_ms = 0
+
+    def feed(self, block: bytes) -> None:
+        "called by PCMRecorder for each captured block"
+        import numpy as np
+        self.chunk.extend(block)
+        samples = np.frombuffer(block, dtype=np.int16).astype(np.float32)
+        rms = float(np.sqrt(np.mean(samples ** 2))) if len(samples) else 0.0
+        if rms < self.silence_rms:
+            self.silent_ms += len(samples) * 1000 // self.sample_rate
+        else:
+            self.silent_ms = 0
+            self.has_voice = True
+
+        if len(self.chunk) >= self.min_chunk_bytes and self.silent_ms >= self.silence_ms:
+            self._submit()
+
+    def _submit(self) -> None:
+        if self.has_voice:
+            self.futures.append(self.executor.submit(self.transcribe, bytes(self.chunk)))
+        self.chunk = bytearray()
+        self.has_voice = False
+        self.silent_ms = 0
+
+    def cancel(self) -> None:
+        "drop the chunks that were not sent yet"
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def finish(self) -> str:
+        "send the last chunk then stitch the partial transcripts in order"
+        self._submit()
+        texts = [future.result().strip() for future in self.futures]
+        self.executor.shutdown()
+        text = " ".join(t for t in texts if t)
+        assert text, "Empty text from streaming transcription"
+        return text
 
 
 if __name__ == "__main__":
@@ -1008,7 +3540,7 @@ if __name__ == "__main__":
         print(help(QuickWhisper))
         raise SystemExit()
 
-    if "loop" in kwargs and kwargs["loop"]:
+    if ("loop" in kwargs and kwargs["loop"]) or ("daemon" in kwargs and kwargs["daemon"]):
         try:
             from playsound import playsound
         except Exception:
@@ -1020,19 +3552,18 @@ if __name__ == "__main__":
         if os_type == "Linux":
             import subprocess
         else:
-            from plyer import notification as audio_recorder
+            import sounddevice as sd
         if "--gui" in args or ("gui" in kwargs and kwargs["gui"]):
             import PySimpleGUI as sg
         from pynput import keyboard
         import os
-        import torchaudio
-        import soundfile as sf
-        from litellm import completion, transcription
+        import numpy as np
+        import scipy.signal
+        from litellm import completion, transcription, token_counter
         from deepgram import DeepgramClient, PrerecordedOptions, ClientOptionsFromEnv, SpeakOptions
         import json
         import pyclip
         from piper.voice import PiperVoice as piper
-        import wave
         from openai import OpenAI
 
     try: